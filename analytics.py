@@ -0,0 +1,118 @@
+from models import db, Album, UserStats, all_ratings
+
+TOP_ARTIST_COUNT = 10
+TOP_ARTIST_MIN_RATINGS = 2
+ARTIST_AVERAGE_LIMIT = 50
+
+
+def score_distribution(username):
+    """Returns the number of ratings a user has given each score, lowest score
+    first"""
+
+    ratings = all_ratings()
+
+    rows = db.session.execute(
+        db.select(ratings.c.rating, db.func.count())
+        .where(ratings.c.author == username)
+        .group_by(ratings.c.rating)
+        .order_by(ratings.c.rating)).all()
+
+    return [{'score': score, 'count': count} for score, count in rows]
+
+
+def artist_averages(username):
+    """Returns the number and average score of a user's ratings per album
+    artist, most rated first"""
+
+    ratings = all_ratings()
+    count = db.func.count().label('count')
+    average = db.func.avg(ratings.c.rating).label('average')
+
+    rows = db.session.execute(
+        db.select(Album.artist_id, Album.artist_name, count, average)
+        .select_from(ratings)
+        .join(Album, Album.id == ratings.c.album_id)
+        .where(ratings.c.author == username)
+        .group_by(Album.artist_id, Album.artist_name)
+        .order_by(count.desc(), average.desc())).all()
+
+    return [{
+        'artistId': artist_id,
+        'artistName': artist_name,
+        'count': count,
+        'average': round(float(average), 2)
+    } for artist_id, artist_name, count, average in rows]
+
+
+def monthly_ratings(username):
+    """Returns the number and average score of a user's ratings per calendar
+    month, oldest first"""
+
+    ratings = all_ratings()
+    month = db.func.date_trunc('month', ratings.c.timestamp,
+                               type_=db.DateTime).label('month')
+
+    rows = db.session.execute(
+        db.select(month, db.func.count(), db.func.avg(ratings.c.rating))
+        .where(ratings.c.author == username)
+        .group_by(month)
+        .order_by(month)).all()
+
+    return [{
+        'month': month.strftime('%Y-%m'),
+        'count': count,
+        'average': round(float(average), 2)
+    } for month, count, average in rows]
+
+
+def compute_analytics(username):
+    """Returns a dictionary of a user's rating history statistics, including
+    archived ratings, aggregated by the database so no ratings are loaded"""
+
+    distribution = score_distribution(username)
+    artists = artist_averages(username)
+
+    total = sum(bucket['count'] for bucket in distribution)
+    score_sum = sum(bucket['score'] * bucket['count']
+                    for bucket in distribution)
+
+    top_artists = sorted(
+        (artist for artist in artists
+         if artist['count'] >= TOP_ARTIST_MIN_RATINGS),
+        key=lambda artist: (artist['average'], artist['count']),
+        reverse=True)[:TOP_ARTIST_COUNT]
+
+    return {
+        'ratingCount': total,
+        'averageRating': round(score_sum / total, 2) if total else None,
+        'scoreDistribution': distribution,
+        'averageByArtist': artists[:ARTIST_AVERAGE_LIMIT],
+        'topArtists': top_artists,
+        'ratingsPerMonth': monthly_ratings(username)
+    }
+
+
+def get_user_analytics(username):
+    """Returns a user's rating analytics from their stats row, computing and
+    caching them if they are missing or were cleared by a rating change.
+    They are only cached if no rating changed while they were computed.
+    Returns None if the user does not exist."""
+
+    stats = db.session.get(UserStats, username)
+
+    if stats and stats.analytics is not None:
+        return stats.analytics
+
+    if not stats:
+        stats = UserStats.add_missing(username)
+
+        if not stats:
+            return None
+
+    version = stats.version
+    analytics = compute_analytics(username)
+
+    UserStats.fill(username, version, analytics=analytics)
+    db.session.commit()
+
+    return analytics
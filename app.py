@@ -1,233 +1,307 @@
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, session, redirect, flash, g, url_for, request, jsonify, get_template_attribute
+from dotenv import load_dotenv
+
+# Loaded once, before the app's modules, some of which read settings at import
+load_dotenv()
+
+import asyncio
+
+import click
+from flask import Flask, Blueprint, Response, request, jsonify, abort, current_app, stream_with_context
 from flask_cors import CORS
 from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required, JWTManager
-from models import connect_db, db,  User, Rating, Album, DEFAULT_USER_IMAGE
+from models import connect_db, upgrade_db, db,  User, Rating, RatingArchive, Album, Follow, UserStats, UserRecommendation, SimilarAlbum, AlbumRecommendation, TrendingAlbum, CacheVersion, TRENDING_WINDOWS, DEFAULT_USER_IMAGE, user_ratings_version_key, album_ratings_version_key, follows_version_key
+import jobs
+import metrics
+from ratelimit import RateLimiter
+from cache import VersionedCache
+from catalog import get_album, get_albums, get_artist, add_rated_album
+from analytics import get_user_analytics
+from search import cached_search, filled_search, autocomplete
+from feed import stream_feed, create_stream_token, read_stream_token
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import or_
-from forms import LoginForm, SignupForm, CSRFProtectForm, EditRatingForm, AddRatingForm, EditUserForm, SearchForm
-from spotify import get_access_token, get_album_info, album_search, artist_search, get_artist_info, get_artists_albums
-from functools import wraps
-from dotenv import load_dotenv
-from datetime import datetime, timedelta
-from math import floor
+from sqlalchemy.orm import joinedload
+from spotify import SpotifyError, SpotifyUnavailable
 
-app = Flask(__name__)
-CORS(app)
+api = Blueprint('api', __name__, cli_group=None)
+jwt = JWTManager()
+limiter = RateLimiter()
+ratings_cache = VersionedCache()
 
-load_dotenv()
+MAX_BATCH_SIZE = 250
+RATINGS_PAGE_SIZE = 50
+MAX_RATINGS_PAGE_SIZE = 200
+RATED_ALBUM_FIELDS = ("name", "imageUrl", "artistName", "artistId")
+# Longest value of each editable profile field, None if unlimited
+PROFILE_FIELD_LENGTHS = {
+    "firstName": 25, "lastName": 25, "imageUrl": 255, "bio": None}
+
+
+def create_app(config=None):
+    """Creates the app, configured from the environment and .env, then from
+    `config`. The template views and their forms are only loaded when
+    LEGACY_VIEWS is set."""
+
+    app = Flask(__name__)
+    CORS(app)
 
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-app.config['JWT_SECRET_KEY'] = os.environ['SECRET_KEY']
+    app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+    app.config['JWT_SECRET_KEY'] = os.environ['SECRET_KEY']
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
-    "DATABASE_URL", 'postgresql:///album_rater')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        "DATABASE_URL", 'postgresql:///album_rater')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = True
 
+    if "DB_POOL_SIZE" in os.environ:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': int(os.environ["DB_POOL_SIZE"])}
 
-connect_db(app)
-jwt = JWTManager(app)
+    app.config['RATELIMIT_ENABLED'] = os.environ.get(
+        "RATELIMIT_ENABLED", 'true').lower() in ('1', 'true')
+    app.config['RATELIMIT_STORAGE_URL'] = os.environ.get(
+        "RATELIMIT_STORAGE_URL", 'memory://')
+    app.config['RATELIMIT_DEFAULT'] = os.environ.get(
+        "RATELIMIT_DEFAULT", '600/minute')
+
+    app.config['CACHE_URL'] = os.environ.get("CACHE_URL")
+    app.config['CACHE_SIZE'] = int(os.environ.get("CACHE_SIZE", 1000))
+    app.config['CACHE_TTL'] = int(os.environ.get("CACHE_TTL", 300))
+
+    app.config['FEED_STREAMING'] = os.environ.get(
+        "FEED_STREAMING", 'false').lower() in ('1', 'true')
+    app.config['FEED_STREAM_MAX_DURATION'] = int(os.environ.get(
+        "FEED_STREAM_MAX_DURATION", 300))
+
+    app.config['LEGACY_VIEWS'] = os.environ.get(
+        "LEGACY_VIEWS", 'false').lower() in ('1', 'true')
+
+    app.config.update(config or {})
+
+    connect_db(app)
+    jwt.init_app(app)
+    limiter.init_app(app)
+    ratings_cache.init_app(app)
+
+    app.register_blueprint(api)
+
+    if app.config['LEGACY_VIEWS']:
+        from legacy import legacy
+        app.register_blueprint(legacy)
+
+    return app
 
-CURR_USER_KEY = "active_user"
 
 ################################### Helpers ####################################
 
 
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+@api.cli.command('upgrade-db')
+def upgrade_database():
+    """Creates missing tables and adds the columns and indexes that newer
+    models need to existing ones. Run it on every deploy."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    upgrade_db()
 
-    else:
-        g.user = None
 
+@api.cli.command('rebuild-user-stats')
+def rebuild_user_stats():
+    """Recounts the follower, following and rating counts of every user"""
 
-@app.before_request
-def add_csrfform_to_g():
-    """Add CSRF protection form to Flask global."""
+    jobs.rebuild_user_stats()
 
-    g.csrf_form = CSRFProtectForm()
 
+@api.cli.command('recommend-users')
+def recommend_users():
+    """Recomputes the follow recommendations of every user"""
 
-def login_required(f):
-    """Decorator to make sure the user is logged in"""
+    from recommendations import compute_user_recommendations
+    compute_user_recommendations()
 
-    @wraps(f)
-    def login_decorator(*args, **kwargs):
-        if not g.user:
-            flash("Access unauthorized.", "danger")
-            return redirect(url_for("handle_login_page"))
-        return f(*args, **kwargs)
-    return login_decorator
 
+@api.cli.command('recommend-albums')
+def recommend_albums():
+    """Recomputes the similar albums of every album and the album
+    recommendations of every user"""
 
-def token_required(f):
-    """Decorator to make sure Spotify API token is still valid, generates new
-    one if not"""
+    from recommendations import compute_album_recommendations
+    compute_album_recommendations()
 
-    @wraps(f)
-    def token_decorator(*args, **kwargs):
-        if hasattr(g, 'spotify_token'):
-            if g.spotify_token['exp_time'] > datetime.now():
-                return f(*args, **kwargs)
 
-        g.spotify_token = get_access_token()
+@api.cli.command('compact-trending')
+def compact_trending():
+    """Rebuilds the trending album scores from the ratings table"""
 
-        return f(*args, **kwargs)
-    return token_decorator
+    jobs.compact_trending()
 
 
-@app.template_filter()
-def format_runtime(milliseconds):
-    """Formats time in milliseconds to min:sec"""
-    total_sec = milliseconds / 1000
-    min = floor(total_sec / 60)
-    sec = floor(total_sec % 60)
+@api.cli.command('archive-ratings')
+@click.option('--days', type=int, help="Archive ratings older than this.")
+def archive_ratings(days):
+    """Moves old ratings from the ratings table to the archive table"""
 
-    if sec < 10:
-        sec_str = f'0{sec}'
-    else:
-        sec_str = f'{sec}'
+    moved = jobs.archive_ratings(days)
+    click.echo(f"Archived {moved} ratings.")
 
-    return f'{min}:{sec_str}'
 
+@api.cli.command('run-worker')
+@click.option('--burst', is_flag=True, help="Exit once the queue is empty.")
+def run_worker(burst):
+    """Runs background jobs from the jobs table"""
 
-def do_login(user):
-    """Log in user."""
+    jobs.work(burst=burst)
 
-    session[CURR_USER_KEY] = user.username
 
+@api.cli.command('enqueue-job')
+@click.argument('kind')
+def enqueue_job(kind):
+    """Queues a job that takes no arguments, e.g. from cron"""
 
-def do_logout():
-    """Log out user."""
+    jobs.load_handlers()
 
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
+    if kind not in jobs.HANDLERS:
+        raise click.BadParameter(
+            f"Choose from {', '.join(sorted(jobs.HANDLERS))}.",
+            param_hint="KIND")
 
-################################# Base Routes ##################################
+    jobs.enqueue(kind, dedup_key=kind)
+    db.session.commit()
 
 
-# @app.get('/')
-# def homepage():
-#     """Show homepage"""
+@api.app_errorhandler(SpotifyError)
+def handle_spotify_error(e):
+    """Returns JSON of a failed spotify call instead of crashing the request,
+    telling clients when to retry if spotify is unavailable"""
 
-#     if not g.user:
-#         return redirect(url_for("handle_login_page"))
+    db.session.rollback()
 
-#     home_rating_usernames = [
-#         user.username for user in g.user.following] + [g.user.username]
+    headers = {}
+    if isinstance(e, SpotifyUnavailable):
+        headers["Retry-After"] = str(e.retry_after)
 
-#     ratings = (Rating
-#                .query
-#                .filter(
-#                    Rating.author.in_(home_rating_usernames)
-#                ).order_by(Rating.timestamp.desc())
-#                .limit(100)
-#                .all())
+    return jsonify({"errors": [str(e)]}), e.status_code, headers
 
-#     return render_template('homepage.html', ratings=ratings)
 
+async def in_thread(f, *args, **kwargs):
+    """Awaits a blocking function run in a worker thread with its own app
+    context, and so its own database session, letting async views run
+    several at once. It should return plain data rather than models, since
+    its session is closed when it returns."""
 
-# @app.route('/login', methods=["GET", "POST"])
-# def handle_login_page():
-#     """Login user"""
+    app = current_app._get_current_object()
 
-#     form = LoginForm()
+    def run():
+        with app.app_context():
+            return f(*args, **kwargs)
 
-#     if form.validate_on_submit():
-#         user = User.login(
-#             username=form.username.data,
-#             password=form.password.data)
+    return await asyncio.to_thread(run)
 
-#         if user:
-#             do_login(user)
 
-#             return redirect(url_for('homepage'))
+def get_batch_ids(key, type=str):
+    """Returns the distinct ids listed under `key` in the request's JSON body,
+    in order, or None if it is not a list of at most MAX_BATCH_SIZE ids of the
+    given type"""
 
-#         else:
-#             flash("Invalid Credentials", "danger")
-#             return redirect(url_for('handle_login_page'))
+    body = request.get_json(silent=True)
+    ids = body.get(key) if isinstance(body, dict) else None
 
-#     return render_template('login.html', form=form)
+    if (not isinstance(ids, list) or len(ids) > MAX_BATCH_SIZE or
+            not all(isinstance(id, type) for id in ids)):
+        return None
 
+    return list(dict.fromkeys(ids))
 
-# @app.route('/signup', methods=["GET", "POST"])
-# def handle_signup_form():
-#     """Create new user and log them in"""
 
-#     form = SignupForm()
+def get_limit(default, maximum):
+    """Returns the request's `limit` query parameter clamped between 1 and
+    `maximum`, or `default` if it is missing or not an integer"""
 
-#     if form.validate_on_submit():
-#         try:
-#             user = User.signup(
-#                 username=form.username.data,
-#                 first_name=form.first_name.data,
-#                 last_name=form.last_name.data or None,
-#                 password=form.password.data
-#             )
+    return max(1, min(request.args.get('limit', default, type=int), maximum))
 
-#             db.session.commit()
-#             do_login(user)
 
-#             flash("User created successfully", "success")
-#             return redirect(url_for('show_user_page', username=user.username))
+def batch_error(key):
+    """Returns the error response for an invalid list of batch ids"""
 
-#         except IntegrityError:
-#             flash("Username Taken.", "danger")
-#             return redirect(url_for('handle_signup_form', form=form))
+    return jsonify({"errors": [
+        f"{key} must be a list of at most {MAX_BATCH_SIZE} ids."]}), 400
 
-#     return render_template('signup.html', form=form)
 
+################################# Base Routes ##################################
 
-################################ Search Routes #################################
 
+@api.get('/metrics')
+def get_metrics():
+    """Returns JSON of this worker's counters and timing summaries, such as
+    spotify quota wait times per priority"""
 
-# @app.get('/search')
-# @login_required
-# def search_items():
-#     """Loads search page template"""
+    return jsonify(metrics.snapshot())
 
-#     form = SearchForm(obj={
-#         'searchType': 'album',
-#         'search': None
-#     })
 
-#     return render_template('search.html', form=form)
+################################ Search Routes #################################
 
 
-# @app.get('/search/results')
-# @login_required
-# @token_required
-# def get_search_results():
-#     """Takes search term, type, and offset in the query string and returns JSON
-#     of the results from the spotify API"""
+@api.get('/search/results')
+@limiter.limit('30/minute')
+@jwt_required()
+async def get_search_results():
+    """Takes search term, type, and offset in the query string and returns JSON
+    of the results, using cached spotify results when available. With `fill`
+    set, album and artist searches take a `cursor` instead of an offset and
+    always return full pages along with the cursor of the next page."""
+
+    query = request.args.get("query", "a")
+    search_type = request.args.get("type", "album")
+    offset = request.args.get('offset', 0, type=int)
+
+    if search_type in ("album", "artist") and request.args.get("fill"):
+        try:
+            results, next_cursor, stale = await in_thread(
+                filled_search, search_type, query=query,
+                cursor=request.args.get("cursor"))
+        except ValueError as e:
+            return jsonify({"errors": [str(e)]}), 400
+
+        return jsonify({"results": results, "next": next_cursor,
+                        "stale": stale})
+
+    stale = False
+
+    if search_type in ("album", "artist"):
+        results, stale = await in_thread(
+            cached_search, search_type, query=query, offset=offset)
+
+    elif search_type == "user":
+        results = await in_thread(lambda: [
+            user.serialize()
+            for user in User.search(search=query, offset=offset)])
 
-#     query = request.args.get("query", "a")
-#     search_type = request.args.get("type", "album")
-#     offset = request.args.get('offset')
+    else:
+        return jsonify({"errors": ["type must be album, artist or user."]}), 400
 
-#     if search_type == "album":
-#         results = album_search(query=query, offset=offset,
-#                                token=g.spotify_token['token'])
+    return jsonify({"results": results, "stale": stale})
 
-#     elif search_type == "artist":
-#         results = artist_search(
-#             query=query, offset=offset, token=g.spotify_token['token'])
 
-#     elif search_type == "user":
-#         unserialized_results = User.search(search=query, offset=offset)
-#         results = [user.serialize() for user in unserialized_results]
+@api.get('/search/autocomplete')
+@limiter.limit('120/minute')
+@jwt_required()
+def get_autocomplete_results():
+    """Takes the start of a search term and an optional type in the query
+    string and returns JSON of matching albums and artists from the local
+    index, without calling the spotify API"""
+
+    entries = autocomplete(
+        request.args.get("query", ""), kind=request.args.get("type"))
 
-#     return jsonify(results)
+    return jsonify({"results": [
+        {"type": entry.kind, **entry.serialize()} for entry in entries]})
 
 
 ################################# User Routes ##################################
 
-@app.post('/signup')
+@api.post('/signup')
+@limiter.limit('5/minute', by='ip')
 def signup_user():
     """Create new user and return their jwt token"""
 
@@ -267,7 +341,8 @@ def signup_user():
         return jsonify({"token": token})
 
 
-@app.post('/login')
+@api.post('/login')
+@limiter.limit('10/minute', by='ip')
 def login_user():
     """Checks user credentials and returns token if valid"""
 
@@ -290,341 +365,594 @@ def login_user():
     return jsonify({"token": token})
 
 
-# @app.get('/users/<username>')
-# @login_required
-# def show_user_page(username):
-#     """Show specific user page"""
+@api.get('/users/<username>')
+@limiter.limit('120/minute')
+@jwt_required()
+async def get_user_data(username):
+    """Return JSON data of a specific user"""
 
-#     user = User.query.get_or_404(username)
+    def get_user():
+        user = db.session.get(User, username)
+        return user and user.serialize()
 
-#     return render_template('userPage.html', user=user)
+    user, following = await asyncio.gather(
+        in_thread(get_user),
+        in_thread(Follow.exists, follower=get_jwt_identity()["username"],
+                  followed=username))
 
-@app.get('/users/<username>')
+    if not user:
+        abort(404)
+
+    return jsonify({
+        "user": user,
+        "following": following
+    })
+
+
+@api.post('/users/batch')
+@limiter.limit('30/minute')
 @jwt_required()
-def get_user_data(username):
-    """Return JSON data of a specific user"""
+def get_users_data():
+    """Takes a JSON list of usernames and returns JSON of each user found and
+    whether the signed in user follows them, keyed by username, with one query
+    for all of them. Unknown usernames are listed as missing."""
 
-    user = User.query.get_or_404(username)
-    curr_user = User.query.get(get_jwt_identity()["username"])
+    usernames = get_batch_ids("usernames")
+
+    if usernames is None:
+        return batch_error("usernames")
+
+    rows = (db.session.query(User, Follow.user_following.is_not(None))
+            .outerjoin(Follow, db.and_(
+                Follow.user_being_followed == User.username,
+                Follow.user_following == get_jwt_identity()["username"]))
+            .filter(User.username.in_(usernames))
+            .all())
+
+    users = {user.username: {"user": user.serialize(), "following": following}
+             for user, following in rows}
 
     return jsonify({
-        "user": user.serialize(),
-        "following": curr_user.is_following(user)
+        "users": users,
+        "missing": [username for username in usernames
+                    if username not in users]
     })
 
-@app.post('/users/<username>/follow')
+
+@api.get('/users/<username>/profile')
+@limiter.limit('120/minute')
+@jwt_required()
+async def get_user_profile(username):
+    """Return JSON of a user's cached profile with their follower, following
+    and rating counts. Responds with 304 if the client's ETag is current."""
+
+    def get_profile():
+        stats = UserStats.get_profile(username)
+        return stats and (stats.version, stats.serialize())
+
+    profile, following = await asyncio.gather(
+        in_thread(get_profile),
+        in_thread(Follow.exists, follower=get_jwt_identity()["username"],
+                  followed=username))
+
+    if not profile:
+        return jsonify({"errors": ["User not found."]}), 404
+
+    version, user = profile
+    etag = f"{version}-{int(following)}"
+
+    if request.if_none_match.contains(etag):
+        return "", 304, {"ETag": f'"{etag}"'}
+
+    return jsonify({
+        "user": user,
+        "following": following
+    }), 200, {"ETag": f'"{etag}"'}
+
+
+@api.get('/users/<username>/analytics')
+@limiter.limit('60/minute')
+@jwt_required()
+def get_user_analytics_data(username):
+    """Return JSON of a user's rating history statistics: their score
+    distribution, average score by artist, ratings per month and top artists.
+    Cached until the user's ratings change."""
+
+    analytics = get_user_analytics(username)
+
+    if analytics is None:
+        return jsonify({"errors": ["User not found."]}), 404
+
+    return jsonify({"analytics": analytics})
+
+
+@api.patch('/users/<username>')
+@limiter.limit('20/minute')
+@jwt_required()
+def edit_user(username):
+    """Edit the signed in user's profile and invalidate their cached profile,
+    returns JSON of the updated user"""
+
+    if get_jwt_identity()["username"] != username:
+        return jsonify({"errors": ["Access unauthorized."]}), 403
+
+    data = request.get_json(silent=True)
+
+    if not isinstance(data, dict):
+        return jsonify({"errors": ["Expected a JSON object."]}), 400
+
+    if not all(data.get(key) is None or (
+            isinstance(data[key], str) and
+            (length is None or len(data[key]) <= length))
+            for key, length in PROFILE_FIELD_LENGTHS.items()):
+        return jsonify({"errors": [
+            "firstName and lastName must be strings of at most 25 "
+            "characters, imageUrl at most 255 and bio a string."]}), 400
+
+    if "firstName" in data and not data["firstName"]:
+        return jsonify({"errors": ["firstName is required."]}), 400
+
+    user = User.query.get_or_404(username)
+
+    user.first_name = data.get("firstName", user.first_name)
+    user.last_name = data.get("lastName", user.last_name) or None
+    user.bio = data.get("bio", user.bio) or None
+    user.image_url = data.get("imageUrl", user.image_url) or DEFAULT_USER_IMAGE
+
+    UserStats.invalidate_profile(username)
+    db.session.commit()
+
+    return jsonify({"user": user.serialize()})
+
+
+@api.post('/users/<username>/follow')
+@limiter.limit('60/minute')
 @jwt_required()
 def follow_or_unfollow_user(username):
     """Creates or deletes the following relationship between the given user and
     the signed in user in the database, returns success message"""
 
-    user = User.query.get_or_404(username)
-    curr_user = User.query.get(get_jwt_identity()["username"])
+    User.query.get_or_404(username)
+    curr_username = get_jwt_identity()["username"]
 
-    if curr_user.is_following(user):
-        curr_user.following.remove(user)
+    if Follow.remove(follower=curr_username, followed=username):
         statement = "unfollowed"
 
     else:
-        curr_user.following.append(user)
+        Follow.add(follower=curr_username, followed=username)
         statement = "followed"
 
     db.session.commit()
 
-    return jsonify("User ", statement, " successfully.")
+    return jsonify({"message": f"User {statement} successfully."})
 
-# @app.get('/users/following/<username>')
-# @jwt_required()
-# def is_user_following(username):
-#     """Returns JSON of true or false stating if the current user is following
-#     the given user"""
 
-#     user = User.query.get_or_404(username)
-#     curr_user = User.query.get(get_jwt_identity()["username"])
+@api.put('/users/<username>/follow')
+@limiter.limit('60/minute')
+@jwt_required()
+def follow_user(username):
+    """Makes the signed in user follow the given user. Repeated calls are a
+    no-op, returns JSON stating if a new follow was created"""
 
-#     return jsonify({"answer": curr_user.is_following(user)})
+    curr_username = get_jwt_identity()["username"]
 
+    if curr_username == username:
+        return jsonify({"errors": ["Users cannot follow themselves."]}), 400
 
-# @app.route('/edit-user', methods=["GET", "POST"])
-# @login_required
-# def handle_edit_user_form():
-#     """Edit user"""
+    try:
+        changed = Follow.add(follower=curr_username, followed=username)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"errors": ["User not found."]}), 404
 
-#     form = EditUserForm(obj=g.user)
-#     db.session.rollback()
+    return jsonify({"following": True, "changed": changed})
 
-#     if form.validate_on_submit():
-#         try:
-#             g.user.first_name = form.first_name.data
-#             g.user.last_name = form.last_name.data or None
-#             g.user.bio = form.bio.data or None
-#             g.user.image_url = form.image_url.data or DEFAULT_USER_IMAGE
 
-#             db.session.commit()
+@api.delete('/users/<username>/follow')
+@limiter.limit('60/minute')
+@jwt_required()
+def unfollow_user(username):
+    """Makes the signed in user stop following the given user. Repeated calls
+    are a no-op, returns JSON stating if a follow was removed"""
 
-#             return redirect(url_for('show_user_page', username=g.user.username))
+    changed = Follow.remove(
+        follower=get_jwt_identity()["username"], followed=username)
+    db.session.commit()
 
-#         except ValueError:
-#             flash("Username Taken.", "danger")
-#             return redirect(url_for('handle_edit_user_form', form=form))
+    return jsonify({"following": False, "changed": changed})
 
-#     return render_template('editUserForm.html', form=form)
 
+@api.post('/follows/bulk')
+@limiter.limit('10/minute')
+@jwt_required()
+def bulk_follow_users():
+    """Takes a JSON list of usernames and makes the signed in user follow all
+    of them at once, returns JSON of the newly followed usernames"""
 
-# @app.post('/follow-user/<username>')
-# @login_required
-# def handle_user_follow(username):
-#     """Follows user if not already following, unfollows if they are"""
+    usernames = get_batch_ids("usernames")
 
-#     user = User.query.get_or_404(username)
+    if usernames is None:
+        return batch_error("usernames")
 
-#     if g.user.is_following(user):
-#         g.user.following.remove(user)
+    followed = Follow.add_many(
+        follower=get_jwt_identity()["username"], followed_usernames=usernames)
+    db.session.commit()
 
-#     else:
-#         g.user.following.append(user)
+    return jsonify({"followed": followed})
 
-#     db.session.commit()
 
-#     return redirect(url_for('show_user_page', username=username))
+@api.get('/recommendations/users')
+@jwt_required()
+def get_user_recommendations():
+    """Returns JSON of the precomputed users recommended for the signed in user
+    to follow, best first"""
 
+    limit = get_limit(10, 50)
 
-# @app.post('/logout')
-# @login_required
-# def logout_user():
-#     """Logs user out"""
+    recommendations = (UserRecommendation.query
+                       .options(joinedload(
+                           UserRecommendation.recommended_user))
+                       .filter_by(username=get_jwt_identity()["username"])
+                       .order_by(UserRecommendation.rank)
+                       .limit(limit)
+                       .all())
 
-#     if not g.csrf_form.validate_on_submit():
-#         flash("Access unauthorized.", "danger")
-#         return redirect("/")
+    return jsonify({"recommendations": [
+        recommendation.serialize() for recommendation in recommendations]})
 
-#     do_logout()
-#     return redirect(url_for('handle_login_page'))
+################################# Music Routes #################################
 
 
-# @app.post('/delete-user')
-# @login_required
-# def delete_user():
-#     """Deletes current signed in user"""
+@api.get('/albums/<album_id>')
+@jwt_required()
+async def get_album_data(album_id):
+    """Returns JSON data of an album and its tracks from the local catalog,
+    only calling the spotify API on a miss"""
 
-#     if not g.csrf_form.validate_on_submit():
-#         flash("Access unauthorized.", "danger")
-#         return redirect("/")
+    album, stale = await in_thread(get_album, album_id)
 
-#     do_logout()
-#     g.user.delete_user()
-#     db.session.commit()
-#     return redirect(url_for('handle_signup_form'))
+    return jsonify({"album": album, "stale": stale})
 
 
-################################# Music Routes #################################
+@api.post('/albums/batch')
+@limiter.limit('30/minute')
+@jwt_required()
+def get_albums_data():
+    """Takes a JSON list of album ids and returns JSON of each album in the
+    local catalog, keyed by id. Albums missing from the catalog are listed as
+    missing rather than fetched from spotify, clients get them from
+    /albums/<album_id>."""
 
+    album_ids = get_batch_ids("ids")
 
-# @app.get('/artists/<artist_id>')
-# @login_required
-# @token_required
-# def show_artist_page(artist_id):
-#     """Shows specific artist page"""
+    if album_ids is None:
+        return batch_error("ids")
 
-#     artist = get_artist_info(artist_id, token=g.spotify_token['token'])
+    albums = {album_id: {"album": album, "stale": stale}
+              for album_id, (album, stale) in get_albums(album_ids).items()}
 
-#     return render_template('artistPage.html', artist=artist)
+    return jsonify({
+        "albums": albums,
+        "missing": [album_id for album_id in album_ids
+                    if album_id not in albums]
+    })
 
 
-# @app.get('/albums/<album_id>')
-# @login_required
-# @token_required
-# def show_album(album_id):
-#     """Show individual album page"""
+@api.get('/artists/<artist_id>')
+@jwt_required()
+async def get_artist_data(artist_id):
+    """Returns JSON data of an artist from the local catalog, only calling the
+    spotify API on a miss"""
 
-#     album = get_album_info(album_id, g.spotify_token['token'])
+    artist, stale = await in_thread(get_artist, artist_id)
 
-#     ratings = Rating.query.filter_by(album_id=album_id).all()
+    return jsonify({"artist": artist, "stale": stale})
 
-#     return render_template("albumPage.html", album=album, ratings=ratings)
 
+################################ Rating Routes #################################
 
-# @app.get('/artists/<artist_id>/albums')
-# @login_required
-# @token_required
-# def request_artists_albums(artist_id):
-#     """Takes an artist id as a parameter and an offset amount as a query string
-#     and returns JSON of that artists albums"""
 
-#     offset = request.args.get('offset', 0)
+@api.get('/ratings')
+@limiter.limit('60/minute')
+@jwt_required()
+def get_ratings_data():
+    """Returns JSON data of ratings from database filtered according to the
+    search query parameters, newest first, `limit` at a time. The next page
+    is requested with the returned `before`, which is null on the last page.
+    Archived ratings are only read once the recent ones run out. First pages
+    are cached until a rating in them, or who the user follows, changes."""
 
-#     albums = get_artists_albums(
-#         artist_id=artist_id,
-#         offset=offset,
-#         token=g.spotify_token['token']
-#     )
+    homepage = request.args.get('homepage')
+    user = request.args.get("user")
+    album_id = request.args.get("albumId")
+    limit = get_limit(RATINGS_PAGE_SIZE, MAX_RATINGS_PAGE_SIZE)
 
-#     return jsonify(albums)
+    try:
+        before = datetime.fromisoformat(request.args["before"])
+    except KeyError:
+        before = None
+    except ValueError:
+        return jsonify({"errors": ["before must be an ISO 8601 time."]}), 400
 
+    curr_username = get_jwt_identity()["username"]
 
-################################ Rating Routes #################################
+    if homepage == "True":
+        kind, owner = "feed", curr_username
+    else:
+        kind, owner = ("album_ratings" if album_id else "user_ratings"), user
+
+    cache_key = f"{owner}:{album_id}:{limit}"
+
+    if not before:
+        page = ratings_cache.get(kind, cache_key)
+
+        if page is not None:
+            return jsonify(page)
+
+    # Versions are read before the data they describe, so a write in between
+    # leaves the cached page already out of date rather than wrongly current
+    versions = {}
+
+    if homepage == "True":
+        versions = CacheVersion.get_many([follows_version_key(curr_username)])
+        usernames = [followed for (followed,) in db.session.query(
+            Follow.user_being_followed).filter_by(
+                user_following=curr_username)] + [curr_username]
+    else :
+        usernames = [user]
+
+    if not before:
+        versions.update(CacheVersion.get_many(
+            [user_ratings_version_key(username)
+             for username in usernames if username] +
+            ([album_ratings_version_key(album_id)] if album_id else [])))
+
+    def get_page(model):
+        query = (model.query
+                 .options(joinedload(model.album))
+                 .filter(or_(model.author.in_(usernames),
+                             model.album_id == album_id)))
+
+        if before:
+            query = query.filter(model.timestamp < before)
 
+        return query.order_by(model.timestamp.desc()).limit(limit).all()
 
-# @app.route('/rate-album/<album_id>', methods=["GET", "POST"])
-# @login_required
-# @token_required
-# def handle_rating_form(album_id):
-#     """Create new album rating"""
+    ratings = get_page(Rating)
 
-#     form = AddRatingForm()
+    if len(ratings) < limit:
+        ratings = sorted(ratings + get_page(RatingArchive),
+                         key=lambda rating: rating.timestamp,
+                         reverse=True)[:limit]
 
-#     album = get_album_info(album_id, g.spotify_token['token'])
-#     rating = Rating.query.filter_by(
-#         album_id=album_id, author=g.user.username).one_or_none()
+    page = {
+        "ratings": [rating.serialize() for rating in ratings],
+        "before": (ratings[-1].timestamp.isoformat()
+                   if len(ratings) == limit else None)
+    }
 
-#     song_choices = [(song['name'], song['name']) for song in album['tracks']]
-#     song_choices.insert(0, ('', ''))
-#     form.favorite_song.choices = song_choices
+    if not before:
+        ratings_cache.set(kind, cache_key, page, versions)
 
-#     if rating:
-#         flash("Redirected to edit previous rating", "warning")
-#         return redirect(url_for('edit_rating', album_id=album_id))
+    return jsonify(page)
 
-#     if form.validate_on_submit():
-#         rating = Rating(
-#             rating=form.rating.data,
-#             text=form.text.data,
-#             favorite_song=form.favorite_song.data,
-#             timestamp=datetime.now(),
-#             album_id=album_id,
-#             author=g.user.username
-#         )
 
-#         db_album = Album.query.get(album_id)
+@api.get('/ratings/<int:rating_id>')
+@limiter.limit('120/minute')
+@jwt_required()
+def get_rating_data(rating_id):
+    """Returns JSON data of a single rating from database, archived or not"""
 
-#         if not db_album:
-#             db_album = Album(
-#                 id=album['id'],
-#                 name=album['name'],
-#                 image_url=album['image_url'],
-#                 artist_name=album['artists'][0]['name'],
-#                 artist_id=album['artists'][0]['id']
-#             )
+    rating = (db.session.get(Rating, rating_id) or
+              db.session.get(RatingArchive, rating_id))
 
-#             db.session.add(db_album)
+    if not rating:
+        abort(404)
 
-#         db.session.add(rating)
-#         db.session.commit()
+    return jsonify({"rating": rating.serialize()})
 
-#         return redirect(url_for('show_album', album_id=album_id))
 
-#     return render_template('addRatingForm.html', form=form, album=album)
+@api.post('/ratings/batch')
+@limiter.limit('30/minute')
+@jwt_required()
+def get_ratings_batch_data():
+    """Takes a JSON list of rating ids and returns JSON of each rating found,
+    keyed by id, loading them and their albums in one query, and another for
+    archived ratings if any are not recent. Unknown ids are listed as
+    missing."""
 
+    rating_ids = get_batch_ids("ids", type=int)
 
-# @app.route('/edit-rating/<album_id>', methods=["GET", "POST"])
-# @login_required
-# @token_required
-# def edit_rating(album_id):
-#     """Edit a user's preexisting album rating"""
+    if rating_ids is None:
+        return batch_error("ids")
 
-#     album = get_album_info(album_id, g.spotify_token['token'])
-#     rating = Rating.query.filter_by(
-#         album_id=album_id, author=g.user.username).one_or_404()
+    ratings = (Rating.query
+               .options(joinedload(Rating.album))
+               .filter(Rating.id.in_(rating_ids))
+               .all())
 
-#     form = EditRatingForm(obj=rating)
+    if len(ratings) < len(rating_ids):
+        ratings += (RatingArchive.query
+                    .options(joinedload(RatingArchive.album))
+                    .filter(RatingArchive.id.in_(rating_ids))
+                    .all())
 
-#     song_choices = [(song['name'], song['name']) for song in album['tracks']]
-#     song_choices.insert(0, ('', ''))
-#     form.favorite_song.choices = song_choices
+    found = {rating.id: {"rating": rating.serialize()} for rating in ratings}
 
-#     if form.validate_on_submit():
-#         rating.rating = form.rating.data
-#         rating.text = form.text.data
-#         rating.favorite_song = form.favorite_song.data
+    return jsonify({
+        "ratings": found,
+        "missing": [rating_id for rating_id in rating_ids
+                    if rating_id not in found]
+    })
 
-#         db.session.commit()
 
-#         return redirect(url_for('show_album', album_id=album_id))
+@api.put('/albums/<album_id>/rating')
+@limiter.limit('30/minute')
+@jwt_required()
+def rate_album(album_id):
+    """Creates or replaces the signed in user's rating of an album from JSON
+    with a `rating` from 0.5 to 5 and optionally `favoriteSong` and `text`.
+    Albums not in the catalog yet need an `album` with their name, imageUrl,
+    artistName and artistId. Returns JSON of the rating, with status 201 if it
+    was created."""
+
+    data = request.get_json(silent=True) or {}
+    score = data.get("rating")
+    album = data.get("album")
+
+    if (not isinstance(score, (int, float)) or isinstance(score, bool) or
+            not 0.5 <= score <= 5 or score * 2 != int(score * 2)):
+        return jsonify({"errors": [
+            "rating must be from 0.5 to 5 in steps of 0.5."]}), 400
+
+    if not all(isinstance(data.get(key) or "", str)
+               for key in ("favoriteSong", "text")):
+        return jsonify({"errors": [
+            "favoriteSong and text must be strings."]}), 400
+
+    if album is not None and not (
+            isinstance(album, dict) and
+            all(isinstance(album.get(key), str) for key in RATED_ALBUM_FIELDS)):
+        return jsonify({"errors": [
+            "album must have a name, imageUrl, artistName and artistId."]}), 400
 
-#     return render_template('editRatingForm.html', form=form, album=album)
+    try:
+        if album is not None:
+            add_rated_album(album_id, album["name"], album["imageUrl"],
+                            album["artistName"], album["artistId"])
+
+        rating, created = Rating.upsert(
+            author=get_jwt_identity()["username"], album_id=album_id,
+            rating=score, favorite_song=data.get("favoriteSong") or None,
+            text=data.get("text") or "")
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"errors": ["Album not found."]}), 404
 
+    status = 201 if created else 200
 
-# @app.post('/delete-rating/<int:rating_id>')
-# @login_required
-# def delete_rating(rating_id):
-#     """Delete a rating"""
+    return jsonify({"rating": rating.serialize(), "created": created}), status
 
-#     rating = Rating.query.get_or_404(rating_id)
 
-#     if not g.csrf_form.validate_on_submit():
-#         flash("Access unauthorized.", "danger")
-#         return redirect("/")
+@api.post('/ratings/stream/token')
+@jwt_required()
+def create_ratings_stream_token():
+    """Returns a token for opening the signed in user's feed stream, valid
+    for a few minutes. EventSource can't set headers, so it is passed in the
+    stream's URL, which must not carry the non-expiring login token."""
+
+    token = create_stream_token(get_jwt_identity()["username"])
 
-#     db.session.delete(rating)
-#     db.session.commit()
+    return jsonify({"token": token})
 
-#     return redirect(url_for('show_album', album_id=rating.album_id))
 
+@api.get('/ratings/stream')
+@limiter.limit('10/minute')
+@jwt_required(optional=True)
+def stream_ratings_data():
+    """Streams new and edited ratings in the signed in user's feed as
+    server-sent events, so clients don't poll /ratings. Authorized by the
+    Authorization header or a stream token from /ratings/stream/token as the
+    `token` parameter, which is only checked when the stream opens. Resumes
+    after the Last-Event-ID header, or `lastEventId` parameter, if given.
 
-# @app.get('/ratings/load')
-# @login_required
-# def load_ratings():
-#     """Takes information about the ratings to show in the query string and
-#     returns JSON of the html for those ratings"""
+    Under asgi.py the stream itself is served on the event loop, which only
+    needs this view to authorize it. An open stream holds a whole thread on a
+    WSGI server, so there it is refused unless FEED_STREAMING is set, for a
+    threaded worker class with a thread to spare per client, e.g.
+    `gunicorn -k gthread --threads 100`, and ends after
+    FEED_STREAM_MAX_DURATION seconds, when the client reconnects."""
 
-#     user = request.args.get('user', '')
-#     album_id = request.args.get('albumId', '')
-#     homepage = request.args.get('homepage')
-#     offset = request.args.get('offset', 0)
+    identity = get_jwt_identity()
+    username = (identity["username"] if identity else
+                read_stream_token(request.args.get("token", "")))
 
-#     if homepage:
-#         usernames = [user.username for user in g.user.following] + \
-#             [g.user.username]
-#     else:
-#         usernames = [user]
+    if not username:
+        return jsonify({"errors": ["Invalid or expired stream token."]}), 401
 
-#     ratings = (Rating
-#                .query
-#                .filter(or_(
-#                    Rating.author.in_(usernames),
-#                    Rating.album_id == album_id
-#                )).order_by(Rating.timestamp.desc())
-#                .limit(10)
-#                .offset(offset)
-#                .all())
+    last_id = (request.headers.get("Last-Event-ID") or
+               request.args.get("lastEventId"))
+
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        return jsonify({"errors": ["Invalid last event id."]}), 400
 
-#     get_rating_html = get_template_attribute('rating.html', 'show_rating')
-#     rating_htmls = [get_rating_html(rating) for rating in ratings]
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
-#     return jsonify(rating_htmls)
+    if request.environ.get("feed.async"):
+        request.environ["feed.stream"] = (username, last_id)
+        return Response(mimetype="text/event-stream", headers=headers)
 
+    if not current_app.config['FEED_STREAMING']:
+        return jsonify({
+            "errors": ["Streaming is unavailable, poll /ratings instead."]
+        }), 503
 
-@app.get('/ratings')
+    return Response(
+        stream_with_context(stream_feed(
+            username, last_id, current_app.config['FEED_STREAM_MAX_DURATION'])),
+        mimetype="text/event-stream", headers=headers)
+
+
+@api.get('/albums/trending')
 @jwt_required()
-def get_ratings_data():
-    """Returns JSON data of ratings from database filtered according to the
-    search query parameters"""
+def get_trending_albums():
+    """Returns JSON of the albums with the most recent rating activity in the
+    given window (24h, 7d or all), hottest first"""
 
-    homepage = request.args.get('homepage')
-    user = request.args.get("user")
-    album_id = request.args.get("albumId")
+    window = request.args.get('window', '24h')
+    limit = get_limit(10, 50)
 
-    if homepage == "True":
-        curr_user = User.query.get(get_jwt_identity()["username"])
-        usernames = [user.username for user in curr_user.following] + \
-            [curr_user.username]
-    else :
-        usernames = [user]
+    if window not in TRENDING_WINDOWS:
+        return jsonify({"errors": [
+            f"window must be one of {', '.join(TRENDING_WINDOWS)}."]}), 400
 
-    ratings = (Rating.query.filter(
-        or_(Rating.author.in_(usernames), Rating.album_id == album_id))
-        .order_by(Rating.timestamp.desc())
-        .all()
-        )
+    now = datetime.now()
 
-    return jsonify({"ratings": [rating.serialize() for rating in ratings]})
+    return jsonify({"albums": [
+        trending.serialize(now) for trending in
+        TrendingAlbum.top(window, limit)]})
 
 
-@app.get('/ratings/<int:rating_id>')
+@api.get('/albums/<album_id>/similar')
 @jwt_required()
-def get_rating_data(rating_id):
-    """Returns JSON data of a single rating from database"""
+def get_similar_albums(album_id):
+    """Returns JSON of the precomputed albums most similar to the given album,
+    most similar first"""
 
-    rating = Rating.query.get_or_404(rating_id)
+    limit = get_limit(10, 50)
 
-    return jsonify({"rating": rating.serialize()})
+    similar = (SimilarAlbum.query
+               .options(joinedload(SimilarAlbum.similar_album))
+               .filter_by(album_id=album_id)
+               .order_by(SimilarAlbum.rank)
+               .limit(limit)
+               .all())
+
+    return jsonify({"albums": [album.serialize() for album in similar]})
+
+
+@api.get('/recommendations/albums')
+@jwt_required()
+def get_album_recommendations():
+    """Returns JSON of the precomputed albums recommended for the signed in
+    user, best first"""
+
+    limit = get_limit(10, 50)
+
+    recommendations = (AlbumRecommendation.query
+                       .options(joinedload(AlbumRecommendation.album))
+                       .filter_by(username=get_jwt_identity()["username"])
+                       .order_by(AlbumRecommendation.rank)
+                       .limit(limit)
+                       .all())
+
+    return jsonify({"recommendations": [
+        recommendation.serialize() for recommendation in recommendations]})
+
+
+# Module level app for `gunicorn app:app` and `flask run`
+app = create_app()
@@ -0,0 +1,132 @@
+"""ASGI entry point, for serving many requests in flight per worker:
+
+    uvicorn asgi:application --workers 4
+
+Requests run the flask app in a shared pool of ASGI_THREADS threads rather
+than one request per sync gunicorn worker, so a request waiting on spotify or
+the database only holds a thread. Async views run on the server's event loop
+and await their blocking calls in separate threads. Raise DB_POOL_SIZE to
+match, since every request in flight can hold a database connection.
+
+Feed streams are authorized by their flask view in the pool like any other
+request, then served from the event loop, so an open stream holds no thread
+and ends as soon as its client disconnects.
+"""
+
+import asyncio
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from app import app
+from feed import stream_feed_async
+
+FEED_STREAM_PATH = '/ratings/stream'
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 64))
+
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS,
+                              thread_name_prefix='asgi')
+
+
+class ThreadedWsgiToAsgiInstance(WsgiToAsgiInstance):
+    """Handles one request, running the WSGI app in the shared pool instead of
+    asgiref's single thread-sensitive thread, which would serve one request
+    at a time"""
+
+    run_wsgi_app = sync_to_async(
+        WsgiToAsgiInstance.__dict__['run_wsgi_app'].func,
+        thread_sensitive=False, executor=executor)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """Serves a WSGI app over ASGI with requests running concurrently"""
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        instance = ThreadedWsgiToAsgiInstance(
+            self.wsgi_application, self.duplicate_header_limit)
+
+        if (scope['type'] == 'http' and scope['method'] == 'GET' and
+                scope['path'] == FEED_STREAM_PATH):
+            await self.stream_feed(instance, scope, receive, send)
+        else:
+            await instance(scope, receive, send)
+
+    async def stream_feed(self, instance, scope, receive, send):
+        """Runs the feed stream's view in the pool, then if it authorized the
+        stream sends its events until the client disconnects"""
+
+        instance.scope = scope
+        environ = instance.build_environ(scope, io.BytesIO())
+        environ['feed.async'] = True
+
+        status, headers, body = await asyncio.get_running_loop(
+        ).run_in_executor(executor, dispatch, self.wsgi_application, environ)
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                        for name, value in headers]
+        })
+
+        if 'feed.stream' not in environ:
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        async def pump():
+            events = stream_feed_async(
+                self.wsgi_application, *environ['feed.stream'])
+
+            try:
+                async for chunk in events:
+                    await send({'type': 'http.response.body',
+                                'body': chunk.encode(), 'more_body': True})
+            finally:
+                await events.aclose()
+
+        async def wait_for_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        tasks = [asyncio.ensure_future(pump()),
+                 asyncio.ensure_future(wait_for_disconnect())]
+
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if not tasks[0].cancelled() and tasks[0].exception():
+            raise tasks[0].exception()
+
+
+def dispatch(flask_app, environ):
+    """Handles a request with the flask app, returning its status, headers
+    and body"""
+
+    with flask_app.request_context(environ):
+        try:
+            response = flask_app.full_dispatch_request()
+        except Exception as error:
+            response = flask_app.handle_exception(error)
+
+        return (response.status_code, list(response.headers.items()),
+                b''.join(response.iter_encoded()))
+
+
+application = ThreadedWsgiToAsgi(app)
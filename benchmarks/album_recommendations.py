@@ -0,0 +1,94 @@
+"""Benchmarks the offline album recommendation job on synthetic ratings.
+
+Run from the repository root:
+
+    python -m benchmarks.album_recommendations --ratings 1000000
+
+Prints a JSON report of the time taken by each stage.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from recommendations import (build_rating_matrix, similar_albums,
+                             recommend_albums, chunks_to_matrix,
+                             ALBUM_CHUNK_SIZE)
+
+
+def synthetic_ratings(rating_count, user_count, album_count, seed=0):
+    """Generates unique (user, album, score) arrays where album popularity and
+    user activity both follow a Zipf-like skew"""
+
+    rng = np.random.default_rng(seed)
+
+    album_weights = 1 / np.arange(1, album_count + 1) ** 0.8
+    user_weights = 1 / np.arange(1, user_count + 1) ** 0.6
+
+    users = rng.choice(user_count, size=int(rating_count * 1.2),
+                       p=user_weights / user_weights.sum())
+    albums = rng.choice(album_count, size=int(rating_count * 1.2),
+                        p=album_weights / album_weights.sum())
+
+    pairs = np.unique(users.astype(np.int64) * album_count + albums)
+    pairs = rng.permutation(pairs)[:rating_count]
+
+    scores = rng.integers(1, 11, size=len(pairs)) / 2
+
+    return pairs // album_count, pairs % album_count, scores
+
+
+def timed(stage, timings, fn):
+    """Runs `fn`, records its duration in seconds under `stage` and returns
+    its result"""
+
+    start = time.perf_counter()
+    result = fn()
+    timings[stage] = round(time.perf_counter() - start, 3)
+
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ratings', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--albums', type=int, default=50_000)
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--n', type=int, default=50)
+    parser.add_argument('--chunk-size', type=int, default=ALBUM_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    timings = {}
+
+    users, albums, scores = timed('generate', timings, lambda: synthetic_ratings(
+        args.ratings, args.users, args.albums))
+
+    rating_matrix = timed('build_matrix', timings, lambda: build_rating_matrix(
+        users, albums, scores, shape=(args.users, args.albums)))
+
+    similar = timed('similar_albums', timings, lambda: list(similar_albums(
+        rating_matrix, k=args.k, chunk_size=args.chunk_size)))
+
+    similarity = chunks_to_matrix(similar, shape=(args.albums, args.albums))
+
+    recommendations = timed('recommend_albums', timings, lambda: list(
+        recommend_albums(rating_matrix, similarity, n=args.n)))
+
+    json.dump({
+        'benchmark': 'album_recommendations',
+        'params': vars(args),
+        'ratings': len(scores),
+        'similar_rows': int(sum(len(chunk[0]) for chunk in similar)),
+        'recommendation_rows': int(
+            sum(len(chunk[0]) for chunk in recommendations)),
+        'seconds': timings
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Compares requests in flight per worker under gunicorn sync and ASGI.
+
+Seed a database with benchmarks/seed.py, then from the repository root:
+
+    DATABASE_URL=postgresql:///album_rater_bench \\
+        python -m benchmarks.concurrency --concurrency 1 8 32 64
+
+Starts the fake spotify server and then, for each server mode, a single
+worker process of the app pointed at it. At each concurrency level the
+clients request albums missing from the local catalog, so every request waits
+on a spotify round trip, and user pages, which only hit the database. Prints
+a JSON report of throughput and latency per mode and concurrency level.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.load import Recorder
+from benchmarks.seed import username, PASSWORD
+
+SERVERS = {
+    'gunicorn_sync': ['gunicorn', '--workers', '1', '--bind',
+                      '127.0.0.1:{port}', 'app:app'],
+    'uvicorn_asgi': ['uvicorn', '--workers', '1', '--port', '{port}',
+                     '--log-level', 'warning', 'asgi:application']
+}
+
+
+def wait_until_up(url, timeout=30):
+    """Polls a server until it answers"""
+
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url + '/metrics', timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+
+    raise RuntimeError(f"Server at {url} did not start.")
+
+
+def run_level(url, headers, concurrency, count, run_id, users):
+    """Sends `count` requests with `concurrency` clients and returns the
+    statistics of each request type"""
+
+    recorder = Recorder()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+
+    def send(number):
+        if number % 2:
+            name, path = 'user', f'/users/{username(number % users)}'
+        else:
+            name, path = 'album', f'/albums/bench{run_id}x{number}'
+
+        start = time.perf_counter()
+        try:
+            ok = session.get(url + path, headers=headers, timeout=60).ok
+        except requests.RequestException:
+            ok = False
+        recorder.record(name, time.perf_counter() - start, ok)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(count)))
+
+    return recorder.report(time.monotonic() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 8, 32, 64])
+    parser.add_argument('--requests', type=int, default=200,
+                        help="Requests sent at each concurrency level.")
+    parser.add_argument('--latency', type=float, default=100,
+                        help="Fake spotify latency in milliseconds.")
+    parser.add_argument('--users', type=int, default=5000,
+                        help="Number of users the database was seeded with.")
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--spotify-port', type=int, default=8101)
+    args = parser.parse_args(argv)
+
+    env = {
+        **os.environ,
+        'RATELIMIT_ENABLED': 'false',
+        'SPOTIFY_API_URL': f'http://127.0.0.1:{args.spotify_port}/v1',
+        'SPOTIFY_TOKEN_URL': f'http://127.0.0.1:{args.spotify_port}/api/token'
+    }
+
+    spotify = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.fake_spotify',
+         '--port', str(args.spotify_port), '--latency', str(args.latency)],
+        stdout=subprocess.DEVNULL)
+
+    url = f'http://127.0.0.1:{args.port}'
+    results = {}
+
+    try:
+        for mode, command in SERVERS.items():
+            server = subprocess.Popen(
+                [part.format(port=args.port) for part in command], env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+            try:
+                wait_until_up(url)
+                token = requests.post(url + '/login', json={
+                    'username': username(0), 'password': PASSWORD
+                }).json()['token']
+                headers = {'Authorization': f'Bearer {token}'}
+
+                # Fresh album ids on every run so each one is a catalog miss
+                run_id = f'{len(results)}t{int(time.time()) % 10 ** 6}'
+
+                results[mode] = {
+                    str(concurrency): run_level(
+                        url, headers, concurrency, args.requests,
+                        f'{run_id}c{concurrency}', args.users)
+                    for concurrency in args.concurrency}
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        spotify.terminate()
+
+    json.dump({
+        'benchmark': 'concurrency',
+        'params': vars(args),
+        'modes': results
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
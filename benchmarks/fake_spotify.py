@@ -0,0 +1,171 @@
+"""Serves a local stand-in for the spotify API with configurable latency.
+
+Run from the repository root:
+
+    python -m benchmarks.fake_spotify --port 8001 --latency 80 --jitter 40
+
+and point the app at it with
+
+    SPOTIFY_API_URL=http://localhost:8001/v1
+    SPOTIFY_TOKEN_URL=http://localhost:8001/api/token
+
+Every album, artist and search returns deterministic made up data for any
+id or query, in the shape the app reads from spotify.
+"""
+
+import argparse
+import json
+import random
+import re
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+IMAGE_URL = "https://i.scdn.co/image/ab67616d0000b273000000000000000000000000"
+
+
+def image_list():
+    """Returns spotify's three image sizes"""
+
+    return [{'url': IMAGE_URL, 'height': size, 'width': size}
+            for size in (640, 300, 64)]
+
+
+def fake_artist(artist_id):
+    """Returns a full artist object"""
+
+    return {
+        'id': artist_id,
+        'name': f'Artist {artist_id}',
+        'images': image_list(),
+        'genres': ['benchmark'],
+        'external_urls': {
+            'spotify': f'https://open.spotify.com/artist/{artist_id}'}
+    }
+
+
+def fake_album(album_id, track_count=10):
+    """Returns a full album object with its tracks"""
+
+    artist_id = f'artist{sum(map(ord, album_id)) % 1000:04d}'
+
+    return {
+        'id': album_id,
+        'name': f'Album {album_id}',
+        'images': image_list(),
+        'release_date': '2020-01-01',
+        'total_tracks': track_count,
+        'artists': [{'id': artist_id, 'name': f'Artist {artist_id}'}],
+        'tracks': {
+            'items': [{
+                'id': f'{album_id}t{number}',
+                'name': f'Track {number}',
+                'disc_number': 1,
+                'track_number': number,
+                'duration_ms': 180000 + number * 1000
+            } for number in range(1, track_count + 1)]
+        }
+    }
+
+
+def fake_search(search_type, query, offset, limit, total=200):
+    """Returns a page of search results"""
+
+    items = []
+    for position in range(offset, min(offset + limit, total)):
+        item_id = (f'{search_type}'
+                   f'{zlib.crc32(f"{query}:{position}".encode()):010d}')
+        if search_type == 'album':
+            album = fake_album(item_id)
+            del album['tracks']
+            items.append(album)
+        else:
+            items.append(fake_artist(item_id))
+
+    return {f'{search_type}s': {'items': items, 'total': total}}
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    """Answers spotify API requests after sleeping for the configured
+    latency"""
+
+    latency = 0.0
+    jitter = 0.0
+
+    def send_json(self, data, status=200):
+        time.sleep(max(0.0, self.latency + random.uniform(
+            -self.jitter, self.jitter)))
+
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.startswith('/api/token'):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            return self.send_json({
+                'access_token': 'benchmark',
+                'token_type': 'Bearer',
+                'expires_in': 3600
+            })
+
+        self.send_json({'error': 'not found'}, 404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == '/v1/search':
+            return self.send_json(fake_search(
+                params.get('type', 'album'), params.get('q', ''),
+                int(params.get('offset', 0)), int(params.get('limit', 20))))
+
+        match = re.fullmatch(r'/v1/albums/([^/]+)', url.path)
+        if match:
+            return self.send_json(fake_album(match[1]))
+
+        match = re.fullmatch(r'/v1/artists/([^/]+)/albums', url.path)
+        if match:
+            albums = [fake_album(f'{match[1]}a{number}')
+                      for number in range(int(params.get('offset', 0)),
+                                          int(params.get('offset', 0)) + 10)]
+            return self.send_json({'items': albums})
+
+        match = re.fullmatch(r'/v1/artists/([^/]+)', url.path)
+        if match:
+            return self.send_json(fake_artist(match[1]))
+
+        self.send_json({'error': 'not found'}, 404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=50,
+                        help="Mean response latency in milliseconds.")
+    parser.add_argument('--jitter', type=float, default=0,
+                        help="Uniform latency jitter in milliseconds.")
+    args = parser.parse_args(argv)
+
+    FakeSpotifyHandler.latency = args.latency / 1000
+    FakeSpotifyHandler.jitter = args.jitter / 1000
+
+    server = ThreadingHTTPServer((args.host, args.port), FakeSpotifyHandler)
+    print(f"Fake spotify listening on http://{args.host}:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""Drives concurrent API traffic at a running server and reports latencies.
+
+Seed a database with benchmarks/seed.py, start the fake spotify server and
+run the app against both with rate limiting off, e.g.
+
+    python -m benchmarks.fake_spotify --latency 80 &
+    RATELIMIT_ENABLED=0 SPOTIFY_API_URL=http://localhost:8001/v1 \\
+        SPOTIFY_TOKEN_URL=http://localhost:8001/api/token \\
+        DATABASE_URL=postgresql:///album_rater_bench \\
+        gunicorn -w 4 app:app &
+
+then from the repository root:
+
+    python -m benchmarks.load --url http://localhost:8000 --concurrency 32
+
+Each worker logs in as a seeded user, picked with the same skew as the seed
+data, then sends a weighted mix of requests for the given duration. Prints a
+JSON report of throughput and p50/p95/p99 latency for each request type, for
+comparing runs before and after a change.
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.seed import username, album_id, PASSWORD
+
+SCENARIOS = {
+    'feed': 30,
+    'album_ratings': 20,
+    'user': 25,
+    'follow': 10,
+    'album': 10,
+    'login': 5
+}
+
+
+class Recorder:
+    """Latencies and failures of each request type, shared by the workers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, seconds, ok):
+        """Records one request"""
+
+        with self.lock:
+            self.latencies[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def report(self, duration):
+        """Returns a dictionary of statistics for each request type and in
+        total"""
+
+        def stats(latencies, errors):
+            latencies = sorted(latencies)
+
+            def percentile(p):
+                """Returns the latency in milliseconds below which a fraction
+                p of requests completed"""
+                index = min(int(p * len(latencies)), len(latencies) - 1)
+                return round(latencies[index] * 1000, 2)
+
+            return {
+                'requests': len(latencies),
+                'errors': errors,
+                'throughput': round(len(latencies) / duration, 2),
+                'mean_ms': round(
+                    sum(latencies) / len(latencies) * 1000, 2)
+                if latencies else 0,
+                'p50_ms': percentile(0.5) if latencies else 0,
+                'p95_ms': percentile(0.95) if latencies else 0,
+                'p99_ms': percentile(0.99) if latencies else 0
+            }
+
+        with self.lock:
+            return {
+                'total': stats(
+                    [latency for latencies in self.latencies.values()
+                     for latency in latencies],
+                    sum(self.errors.values())),
+                'scenarios': {
+                    name: stats(latencies, self.errors[name])
+                    for name, latencies in sorted(self.latencies.items())}
+            }
+
+
+class Worker:
+    """A simulated client with its own HTTP session and login"""
+
+    def __init__(self, args, recorder, rng):
+        self.args = args
+        self.recorder = recorder
+        self.rng = rng
+        self.session = requests.Session()
+        self.username = self.pick_user()
+        self.headers = {}
+
+    def pick_user(self):
+        """Returns a seeded username, favouring the most active users"""
+
+        return username(min(int(self.rng.paretovariate(1.2)) - 1,
+                            self.args.users - 1))
+
+    def pick_album(self):
+        """Returns a seeded album id, favouring the most popular albums"""
+
+        return album_id(min(int(self.rng.paretovariate(1.2)) - 1,
+                            self.args.albums - 1))
+
+    def request(self, name, method, path, **kwargs):
+        """Sends a request and records its latency. Returns the response, or
+        None if it failed to connect."""
+
+        start = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.args.url + path, headers=self.headers,
+                timeout=self.args.timeout, **kwargs)
+        except requests.RequestException:
+            self.recorder.record(name, time.perf_counter() - start, False)
+            return None
+
+        self.recorder.record(name, time.perf_counter() - start,
+                             response.status_code < 400)
+        return response
+
+    def login(self):
+        response = self.request('login', 'POST', '/login', json={
+            'username': self.username, 'password': PASSWORD})
+
+        if response is not None and response.ok:
+            self.headers = {
+                'Authorization': f"Bearer {response.json()['token']}"}
+
+    def feed(self):
+        self.request('feed', 'GET', '/ratings',
+                     params={'homepage': 'True'})
+
+    def album_ratings(self):
+        self.request('album_ratings', 'GET', '/ratings',
+                     params={'albumId': self.pick_album()})
+
+    def user(self):
+        self.request('user', 'GET', f'/users/{self.pick_user()}')
+
+    def follow(self):
+        other = self.pick_user()
+        if other != self.username:
+            self.request('follow', 'POST', f'/users/{other}/follow')
+
+    def album(self):
+        self.request('album', 'GET', f'/albums/{self.pick_album()}')
+
+    def run(self, deadline):
+        """Logs in, then sends weighted random requests until the deadline"""
+
+        self.login()
+
+        names = list(SCENARIOS)
+        weights = [SCENARIOS[name] for name in names]
+
+        while time.monotonic() < deadline:
+            getattr(self, self.rng.choices(names, weights)[0])()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30,
+                        help="Seconds to send requests for.")
+    parser.add_argument('--users', type=int, default=5000,
+                        help="Number of users the database was seeded with.")
+    parser.add_argument('--albums', type=int, default=20000,
+                        help="Number of albums the database was seeded with.")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    recorder = Recorder()
+    workers = [Worker(args, recorder, random.Random(args.seed + number))
+               for number in range(args.concurrency)]
+
+    start = time.monotonic()
+    deadline = start + args.duration
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for result in [executor.submit(worker.run, deadline)
+                       for worker in workers]:
+            result.result()
+
+    json.dump({
+        'benchmark': 'load',
+        'params': vars(args),
+        'seconds': round(time.monotonic() - start, 3),
+        **recorder.report(time.monotonic() - start)
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Benchmarks the fixed cost every API request pays before reaching its view.
+
+Run from the repository root, with the app's environment variables set:
+
+    python -m benchmarks.overhead --requests 2000
+
+Each variant starts a new interpreter, creates the app, and sends requests
+through the test client to /metrics, which does no work of its own. The
+requests carry both a JWT and a legacy session cookie, so any hook meant for
+the session-based template views shows up, with and without the template
+views registered. Prints a JSON report of the per-request time in
+microseconds and the number of SQL queries per request.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks.startup import summarize
+
+PROBE = """
+import json, sys, time
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+import app
+from models import db
+
+count, username = int(sys.argv[1]), sys.argv[2]
+queries = []
+
+with app.app.app_context():
+    # Query logging would dwarf the hooks being measured
+    db.engine.echo = False
+    event.listen(db.engine, 'before_cursor_execute',
+                 lambda *args: queries.append(args[2]))
+    token = create_access_token(identity={'username': username})
+
+client = app.app.test_client()
+with client.session_transaction() as session:
+    session['active_user'] = username
+headers = {'Authorization': f'Bearer {token}'}
+
+client.get('/metrics', headers=headers)
+queries.clear()
+
+timings = []
+for _ in range(count):
+    start = time.perf_counter()
+    client.get('/metrics', headers=headers)
+    timings.append((time.perf_counter() - start) * 1e6)
+
+print(json.dumps({
+    'timings_us': timings,
+    'queries_per_request': len(queries) / count
+}))
+"""
+
+VARIANTS = {
+    'api': {'LEGACY_VIEWS': 'false'},
+    'legacy_views': {'LEGACY_VIEWS': 'true'}
+}
+
+
+def probe(env, count, username):
+    """Runs the probe in a new interpreter and returns its measurements"""
+
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE, str(count), username], env=env,
+        check=True, capture_output=True, text=True).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--username', default='user0',
+                        help="User in the session cookie, e.g. a seeded one.")
+    args = parser.parse_args(argv)
+
+    results = {}
+
+    for variant, overrides in VARIANTS.items():
+        env = {**os.environ, 'RATELIMIT_ENABLED': 'false', **overrides}
+        run = probe(env, args.requests, args.username)
+
+        results[variant] = {
+            'request_us': summarize(run['timings_us']),
+            'queries_per_request': run['queries_per_request']
+        }
+
+    json.dump({
+        'benchmark': 'overhead',
+        'params': vars(args),
+        'variants': results
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Seeds the database with synthetic users, follows, albums and ratings.
+
+Run from the repository root against an empty database:
+
+    DATABASE_URL=postgresql:///album_rater_bench \\
+        python -m benchmarks.seed --users 5000 --ratings 200000
+
+Album popularity, user activity and follower counts are all skewed, so a few
+users follow or rate far more than most. Every user's password is
+"password". Albums are unhydrated stubs, so viewing one goes through spotify,
+or benchmarks/fake_spotify.py.
+"""
+
+import argparse
+import json
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from benchmarks.album_recommendations import synthetic_ratings, timed
+
+PASSWORD = 'password'
+BATCH_SIZE = 5000
+
+
+def username(index):
+    """Returns the username of the seeded user with the given index"""
+
+    return f'user{index}'
+
+
+def album_id(index):
+    """Returns the id of the seeded album with the given index"""
+
+    return f'album{index}'
+
+
+def skewed_follows(user_count, follow_count, seed=0):
+    """Generates unique (follower, followed) index arrays where a few users
+    follow many others and a few are followed by many"""
+
+    followers, followed, _ = synthetic_ratings(
+        follow_count, user_count, user_count, seed=seed + 1)
+    keep = followers != followed
+
+    return followers[keep], followed[keep]
+
+
+def insert_rows(connection, table, rows):
+    """Inserts rows in batches"""
+
+    for start in range(0, len(rows), BATCH_SIZE):
+        connection.execute(table.insert(), rows[start:start + BATCH_SIZE])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--albums', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=100000)
+    parser.add_argument('--ratings', type=int, default=200000)
+    parser.add_argument('--days', type=int, default=90,
+                        help="Spread rating timestamps over this many days.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    from app import app
+    from models import (db, bcrypt, User, Album, Follow, Rating, UserStats,
+                        TrendingAlbum)
+
+    timings = {}
+    rng = np.random.default_rng(args.seed)
+
+    raters, rated, scores = timed('generate', timings, lambda: synthetic_ratings(
+        args.ratings, args.users, args.albums, seed=args.seed))
+    followers, followed = skewed_follows(args.users, args.follows, args.seed)
+
+    now = datetime.now()
+    ages = rng.exponential(args.days / 4, size=len(scores)).clip(0, args.days)
+
+    password = bcrypt.generate_password_hash(PASSWORD).decode('UTF-8')
+    follower_counts = Counter(followed.tolist())
+    following_counts = Counter(followers.tolist())
+    rating_counts = Counter(raters.tolist())
+
+    def seed():
+        with app.app_context(), db.engine.begin() as connection:
+            insert_rows(connection, User.__table__, [{
+                'username': username(index),
+                'first_name': f'User {index}',
+                'password': password
+            } for index in range(args.users)])
+
+            insert_rows(connection, UserStats.__table__, [{
+                'username': username(index),
+                'follower_count': follower_counts[index],
+                'following_count': following_counts[index],
+                'rating_count': rating_counts[index]
+            } for index in range(args.users)])
+
+            insert_rows(connection, Album.__table__, [{
+                'id': album_id(index),
+                'name': f'Album {index}',
+                'image_url': 'https://i.scdn.co/image/benchmark',
+                'artist_name': f'Artist {index % 1000}',
+                'artist_id': f'artist{index % 1000:04d}'
+            } for index in range(args.albums)])
+
+            insert_rows(connection, Follow.__table__, [{
+                'user_following': username(follower),
+                'user_being_followed': username(user)
+            } for follower, user in zip(followers.tolist(), followed.tolist())])
+
+            insert_rows(connection, Rating.__table__, [{
+                'rating': score,
+                'text': '',
+                'timestamp': now - timedelta(days=age),
+                'album_id': album_id(album),
+                'author': username(user)
+            } for user, album, score, age in zip(
+                raters.tolist(), rated.tolist(), scores.tolist(),
+                ages.tolist())])
+
+    timed('insert', timings, seed)
+
+    with app.app_context():
+        timed('trending', timings, TrendingAlbum.compact)
+        db.session.commit()
+
+    json.dump({
+        'benchmark': 'seed',
+        'params': vars(args),
+        'follows': len(followers),
+        'ratings': len(scores),
+        'seconds': timings
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Benchmarks how long a fresh worker process takes to import the app.
+
+Run from the repository root, with the app's environment variables set:
+
+    python -m benchmarks.startup --runs 10
+
+Each run starts a new interpreter, imports app.py (which creates the app) and
+serves one request through the test client, with and without the legacy
+template views. Prints a JSON report of the timings in milliseconds and the
+number of modules loaded.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get('/metrics')
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_request_ms': (served - imported) * 1000,
+    'modules': len(sys.modules)
+}))
+"""
+
+VARIANTS = {
+    'api': {'LEGACY_VIEWS': 'false'},
+    'legacy_views': {'LEGACY_VIEWS': 'true'}
+}
+
+
+def probe(env):
+    """Runs the probe in a new interpreter and returns its measurements"""
+
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE], env=env, check=True,
+        capture_output=True, text=True).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(values):
+    """Returns the mean, median, minimum and maximum of some timings"""
+
+    return {
+        'mean': round(statistics.mean(values), 2),
+        'p50': round(statistics.median(values), 2),
+        'min': round(min(values), 2),
+        'max': round(max(values), 2)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    results = {}
+
+    for variant, overrides in VARIANTS.items():
+        env = {**os.environ, **overrides}
+        runs = [probe(env) for _ in range(args.runs)]
+
+        results[variant] = {
+            'import_ms': summarize([run['import_ms'] for run in runs]),
+            'first_request_ms': summarize(
+                [run['first_request_ms'] for run in runs]),
+            'modules': runs[-1]['modules']
+        }
+
+    json.dump({
+        'benchmark': 'startup',
+        'params': vars(args),
+        'variants': results
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""Checks that concurrent rating submissions stay consistent and measures
+their latency.
+
+Seed a database with benchmarks/seed.py and run the app against it with rate
+limiting off (see benchmarks/load.py), then from the repository root:
+
+    python -m benchmarks.upsert --url http://localhost:8000 --concurrency 32
+
+Or run it in-process against any empty or existing database, with no seeded
+users and no server, sending the requests through the flask test client:
+
+    DATABASE_URL=postgresql:///album_rater_check \\
+        python -m benchmarks.upsert --local
+
+The local run creates any missing tables and signs up its own users.
+
+Logs in as the first --users seeded users, who each rate --albums albums that
+are new to the catalog --repeats times, with every submission for all pairs
+sent concurrently in a random order. So the same album is inserted by many
+requests at once and the same rating is created and updated at once. Then
+checks that each rating was created exactly once, that each album has one
+rating per user and that each user's denormalized rating count matches their
+ratings. Prints a JSON report of the latencies and any inconsistencies.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.load import Recorder
+from benchmarks.seed import username, PASSWORD
+
+
+def login(session, url, name):
+    """Returns authorization headers for a seeded user"""
+
+    token = session.post(url + '/login', json={
+        'username': name, 'password': PASSWORD}).json()['token']
+
+    return {'Authorization': f'Bearer {token}'}
+
+
+def signup(session, url, name):
+    """Signs up a new user and returns their authorization headers"""
+
+    token = session.post(url + '/signup', json={
+        'username': name, 'firstName': name, 'password': PASSWORD
+    }).json()['token']
+
+    return {'Authorization': f'Bearer {token}'}
+
+
+class LocalResponse:
+    """The parts of a requests.Response the check reads"""
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.body = response.get_json()
+
+    def json(self):
+        return self.body
+
+
+class LocalSession:
+    """Stands in for a requests.Session, sending each request through a new
+    flask test client so the app handles them concurrently in this process"""
+
+    def __init__(self, app, url):
+        self.app = app
+        self.url = url
+
+    def request(self, method, url, headers=None, json=None, params=None,
+                timeout=None):
+        return LocalResponse(self.app.test_client().open(
+            url[len(self.url):], method=method, headers=headers, json=json,
+            query_string=params))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+
+def local_session(url, concurrency):
+    """Creates the app with rate limiting off and a connection per client,
+    creates any missing tables and returns a LocalSession for it"""
+
+    os.environ['RATELIMIT_ENABLED'] = 'false'
+    os.environ.setdefault('DB_POOL_SIZE', str(concurrency))
+
+    from app import app
+    from models import db
+
+    with app.app_context():
+        # Query logging would bury the report
+        db.engine.echo = False
+        db.create_all()
+
+    return LocalSession(app, url)
+
+
+def check_counts(session, url, headers, names, album_ids):
+    """Returns a list of the inconsistencies found after the run"""
+
+    problems = []
+
+    for album_id in album_ids:
+        ratings = session.get(url + '/ratings', headers=headers, params={
+            'albumId': album_id}).json()['ratings']
+        authors = Counter(rating['author'] for rating in ratings)
+
+        if sorted(authors) != sorted(names) or max(authors.values()) > 1:
+            problems.append(f"{album_id} has ratings by {dict(authors)}")
+
+    for name in names:
+        profile = session.get(f'{url}/users/{name}/profile',
+                              headers=headers).json()['user']
+        analytics = session.get(f'{url}/users/{name}/analytics',
+                                headers=headers).json()['analytics']
+
+        if profile['ratingCount'] != analytics['ratingCount']:
+            problems.append(
+                f"{name} has a rating count of {profile['ratingCount']} but "
+                f"{analytics['ratingCount']} ratings")
+
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--albums', type=int, default=10)
+    parser.add_argument('--repeats', type=int, default=4,
+                        help="Submissions of each user's rating of an album.")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--local', action='store_true',
+                        help="Run the app in this process and sign up new "
+                             "users instead of using seeded ones.")
+    args = parser.parse_args(argv)
+
+    # Output from the app would mix with the report
+    with redirect_stdout(sys.stderr):
+        report = run(args)
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+def run(args):
+    """Runs the check and returns its report"""
+
+    rng = random.Random(args.seed)
+
+    # Fresh album ids on every run so each one is inserted concurrently
+    run_id = int(time.time()) % 10 ** 6
+    album_ids = [f'upsert{run_id}x{number}' for number in range(args.albums)]
+
+    if args.local:
+        session = local_session(args.url, args.concurrency)
+        names = [f'upsert{run_id}u{number}' for number in range(args.users)]
+        headers = {name: signup(session, args.url, name) for name in names}
+    else:
+        session = requests.Session()
+        session.mount('http://', requests.adapters.HTTPAdapter(
+            pool_maxsize=args.concurrency))
+        names = [username(number) for number in range(args.users)]
+        headers = {name: login(session, args.url, name) for name in names}
+
+    submissions = [(name, album_id, rng.randint(1, 10) / 2)
+                   for name in names for album_id in album_ids
+                   for _ in range(args.repeats)]
+    rng.shuffle(submissions)
+
+    recorder = Recorder()
+
+    def submit(submission):
+        """Sends one rating and returns the response's status"""
+
+        name, album_id, score = submission
+
+        start = time.perf_counter()
+        try:
+            status = session.put(
+                f'{args.url}/albums/{album_id}/rating', headers=headers[name],
+                timeout=args.timeout, json={
+                    'rating': score,
+                    'text': f'{name} on {album_id}',
+                    'album': {
+                        'name': album_id,
+                        'imageUrl': 'https://example.com/cover.jpg',
+                        'artistName': 'Upsert Benchmark',
+                        'artistId': 'upsertbenchmark'
+                    }}).status_code
+        except requests.RequestException:
+            status = 'failed'
+
+        recorder.record('upsert', time.perf_counter() - start,
+                        status in (200, 201))
+        return status
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        statuses = Counter(executor.map(submit, submissions))
+    duration = time.monotonic() - start
+
+    problems = check_counts(session, args.url, headers[names[0]], names,
+                            album_ids)
+
+    if statuses[201] != len(names) * len(album_ids):
+        problems.append(f"{statuses[201]} ratings were created, expected "
+                        f"{len(names) * len(album_ids)}")
+
+    return {
+        'benchmark': 'upsert',
+        'params': vars(args),
+        'seconds': round(duration, 3),
+        'statuses': {str(status): count for status, count in statuses.items()},
+        'consistent': not problems,
+        'problems': problems,
+        **recorder.report(duration)
+    }
+
+
+if __name__ == '__main__':
+    main()
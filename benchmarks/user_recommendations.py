@@ -0,0 +1,79 @@
+"""Benchmarks the offline user recommendation job on synthetic data.
+
+Run from the repository root:
+
+    python -m benchmarks.user_recommendations --ratings 1000000 --chunks 3
+
+Scores the first --chunks chunks of users, or all of them if it is 0, and
+prints a JSON report of the time taken by each stage and by each chunk, and
+the peak resident memory of the process.
+"""
+
+import argparse
+import json
+import resource
+import sys
+import time
+from itertools import islice
+
+from benchmarks.album_recommendations import synthetic_ratings, timed
+from benchmarks.seed import skewed_follows
+from recommendations import (build_follow_matrix, build_rating_matrix,
+                             recommend_users, USER_CHUNK_SIZE,
+                             TASTE_MAX_RATERS)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ratings', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--albums', type=int, default=50_000)
+    parser.add_argument('--follows', type=int, default=1_000_000)
+    parser.add_argument('--n', type=int, default=20)
+    parser.add_argument('--chunk-size', type=int, default=USER_CHUNK_SIZE)
+    parser.add_argument('--max-raters', type=int, default=TASTE_MAX_RATERS,
+                        help="Albums with more raters are left out of taste.")
+    parser.add_argument('--chunks', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    timings = {}
+
+    users, albums, scores = timed('generate', timings, lambda: synthetic_ratings(
+        args.ratings, args.users, args.albums))
+    followers, followed = skewed_follows(args.users, args.follows)
+
+    usernames = list(range(args.users))
+    rating_matrix = timed('build_matrix', timings, lambda: build_rating_matrix(
+        users, albums, scores, shape=(args.users, args.albums)))
+    follow_matrix = build_follow_matrix(followers, followed, usernames)
+
+    chunks = recommend_users(follow_matrix, rating_matrix, n=args.n,
+                             chunk_size=args.chunk_size,
+                             max_raters=args.max_raters)
+
+    chunk_seconds = []
+    rows = 0
+    start = time.perf_counter()
+
+    for chunk in islice(chunks, args.chunks or None):
+        chunk_seconds.append(round(time.perf_counter() - start, 3))
+        rows += len(chunk[0])
+        start = time.perf_counter()
+
+    timings['recommend_users'] = round(sum(chunk_seconds), 3)
+
+    json.dump({
+        'benchmark': 'user_recommendations',
+        'params': vars(args),
+        'ratings': len(scores),
+        'recommendation_rows': rows,
+        'chunk_seconds': chunk_seconds,
+        'peak_rss_mb': round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024),
+        'seconds': timings
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
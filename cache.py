@@ -0,0 +1,151 @@
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+
+import metrics
+from models import CacheVersion
+from sqlite_table import SQLiteTable
+
+
+class LRUCache:
+    """The most recently used entries, kept in this process"""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        """Returns an entry, or None if it is missing or expired"""
+
+        with self.lock:
+            item = self.entries.get(key)
+
+            if item is None:
+                return None
+
+            value, expires_at = item
+
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        """Adds an entry, evicting the least recently used if full"""
+
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class SQLiteCache:
+    """Entries kept as JSON in a SQLite file, shared by every worker process
+    on the host"""
+
+    def __init__(self, path):
+        self.table = SQLiteTable(
+            path, 'cache_entries',
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL")
+
+    def get(self, key):
+        """Returns an entry, or None if it is missing or expired"""
+
+        row = self.table.read(
+            "SELECT value FROM cache_entries WHERE key = ? AND expires_at >= ?",
+            (key, time.time()))
+
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, expires_at):
+        """Adds or replaces an entry"""
+
+        self.table.write(
+            "INSERT INTO cache_entries (key, value, expires_at) "
+            "VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+            "value = excluded.value, expires_at = excluded.expires_at",
+            (key, current_app.json.dumps(value), expires_at))
+
+
+def create_shared_cache(url):
+    """Creates the shared cache tier from a URL, sqlite:///path/to/file, or
+    returns None if no URL is given"""
+
+    if url and url.startswith('sqlite:///'):
+        return SQLiteCache(url[len('sqlite:///'):])
+
+    return None
+
+
+class VersionedCache:
+    """Two level cache of computed responses, such as the first page of a
+    feed: an LRU in each process in front of an optional cache shared by the
+    workers. Each entry records the versions of the data it was built from,
+    and is only served while they are current, so writes invalidate exactly
+    the entries they affect. Hits and misses are counted per kind of entry
+    under cache.<kind>.memory, .shared and .miss."""
+
+    def __init__(self, app=None):
+        self.memory = LRUCache(1000)
+        self.shared = None
+        self.ttl = 300
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configures the cache from CACHE_SIZE, CACHE_TTL and the optional
+        CACHE_URL of the shared tier"""
+
+        app.config.setdefault('CACHE_SIZE', 1000)
+        app.config.setdefault('CACHE_TTL', 300)
+        app.config.setdefault('CACHE_URL', None)
+
+        self.memory = LRUCache(app.config['CACHE_SIZE'])
+        self.shared = create_shared_cache(app.config['CACHE_URL'])
+        self.ttl = app.config['CACHE_TTL']
+
+    def get(self, kind, key):
+        """Returns a cached value if its versions are still current, checking
+        them with one query, otherwise None"""
+
+        key = f'{kind}:{key}'
+        level = 'memory'
+        entry = self.memory.get(key)
+
+        if entry is None and self.shared:
+            level = 'shared'
+            entry = self.shared.get(key)
+
+        if (entry is not None and
+                CacheVersion.get_many(entry['versions']) == entry['versions']):
+            if level == 'shared':
+                self.memory.set(key, entry, time.time() + self.ttl)
+
+            metrics.increment(f'cache.{kind}.{level}')
+            return entry['value']
+
+        metrics.increment(f'cache.{kind}.miss')
+        return None
+
+    def set(self, kind, key, value, versions):
+        """Caches a value built from data at the given versions, which must
+        have been read before the data"""
+
+        key = f'{kind}:{key}'
+        entry = {'versions': versions, 'value': value}
+        expires_at = time.time() + self.ttl
+
+        self.memory.set(key, entry, expires_at)
+
+        if self.shared:
+            self.shared.set(key, entry, expires_at)
@@ -0,0 +1,213 @@
+from datetime import datetime, timedelta
+from functools import wraps
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+
+from jobs import enqueue, job_handler
+from models import db, Album, Artist, AlbumArtist, Track
+from spotify import (get_token, get_album_info, get_artist_info,
+                     SpotifyUnavailable)
+
+CATALOG_MAX_AGE = timedelta(days=7)
+
+
+def is_stale(fetched_at):
+    """Checks if data fetched at the given time is due for a refresh"""
+
+    return fetched_at < datetime.now() - CATALOG_MAX_AGE
+
+
+def get_album(album_id):
+    """Returns album data in the shape of `spotify.get_album_info` from the
+    local catalog and whether it is stale. Fetches it from spotify on a miss
+    and schedules a background refresh job when the local copy is stale. If
+    spotify is unavailable, an album only known from ratings is served without
+    its tracks, marked stale."""
+
+    album = db.session.get(Album, album_id)
+
+    if not album or not album.fetched_at:
+        try:
+            data = get_album_info(album_id, get_token())
+        except SpotifyUnavailable:
+            if not album:
+                raise
+
+            return album.to_info(), True
+
+        album = store_album(data)
+        return album.to_info(), False
+
+    stale = is_stale(album.fetched_at)
+
+    if stale:
+        enqueue('refresh_album', {'album_id': album_id},
+                dedup_key=f'refresh_album:{album_id}')
+        db.session.commit()
+
+    return album.to_info(), stale
+
+
+def get_artist(artist_id):
+    """Returns artist data in the shape of `spotify.get_artist_info` from the
+    local catalog and whether it is stale. Fetches it from spotify on a miss
+    and schedules a background refresh job when the local copy is stale."""
+
+    artist = db.session.get(Artist, artist_id)
+
+    if not artist or not artist.fetched_at:
+        artist = store_artist(get_artist_info(artist_id, get_token()))
+        return artist.to_info(), False
+
+    stale = is_stale(artist.fetched_at)
+
+    if stale:
+        enqueue('refresh_artist', {'artist_id': artist_id},
+                dedup_key=f'refresh_artist:{artist_id}')
+        db.session.commit()
+
+    return artist.to_info(), stale
+
+
+def get_albums(album_ids):
+    """Returns a dictionary of album id to the album's data and whether it is
+    stale, like `get_album`, for the given ids found in the local catalog.
+    Loads them with one query per table rather than one per album, and never
+    calls spotify, so ids missing from the catalog are left out. Stale albums,
+    and those only known from ratings, are scheduled for a refresh."""
+
+    albums = (Album.query
+              .options(selectinload(Album.tracks),
+                       selectinload(Album.album_artists)
+                       .joinedload(AlbumArtist.artist))
+              .filter(Album.id.in_(album_ids))
+              .all())
+
+    results = {}
+
+    for album in albums:
+        stale = not album.fetched_at or is_stale(album.fetched_at)
+        results[album.id] = (album.to_info(), stale)
+
+    for album_id, (_, stale) in results.items():
+        if stale:
+            enqueue('refresh_album', {'album_id': album_id},
+                    dedup_key=f'refresh_album:{album_id}')
+
+    if any(stale for _, stale in results.values()):
+        db.session.commit()
+
+    return results
+
+
+def add_rated_album(album_id, name, image_url, artist_name, artist_id):
+    """Adds an album being rated to the catalog from the details the client
+    already has, unless it is there, without waiting on spotify. A new album
+    is marked as never fetched and a refresh is scheduled to fill in its
+    tracks. The caller commits. Returns True if the album was added."""
+
+    result = db.session.execute(
+        insert(Album)
+        .values(id=album_id, name=name, image_url=image_url,
+                artist_name=artist_name, artist_id=artist_id)
+        .on_conflict_do_nothing())
+
+    if result.rowcount:
+        enqueue('refresh_album', {'album_id': album_id},
+                dedup_key=f'refresh_album:{album_id}')
+
+    return bool(result.rowcount)
+
+
+@job_handler('refresh_album')
+def refresh_album(album_id):
+    """Fetches an album from spotify and stores it in the local catalog"""
+
+    store_album(get_album_info(album_id, get_token()))
+
+
+@job_handler('refresh_artist')
+def refresh_artist(artist_id):
+    """Fetches an artist from spotify and stores it in the local catalog"""
+
+    store_artist(get_artist_info(artist_id, get_token()))
+
+
+def retry_on_conflict(store):
+    """Runs a function that adds or updates catalog rows and commits again,
+    after rolling back, if a concurrent view or refresh inserted the same rows
+    first, so that it updates the rows that now exist"""
+
+    @wraps(store)
+    def wrapper(data):
+        try:
+            return store(data)
+        except IntegrityError:
+            db.session.rollback()
+            return store(data)
+
+    return wrapper
+
+
+@retry_on_conflict
+def store_album(data):
+    """Adds or updates an album, its tracks and its credited artists from
+    `spotify.get_album_info` data and returns the album"""
+
+    db.session.execute(
+        insert(Artist)
+        .values([{
+            'id': artist['id'],
+            'name': artist['name'],
+            'genres': []
+        } for artist in data['artists']])
+        .on_conflict_do_nothing())
+
+    album = db.session.get(Album, data['id']) or Album(id=data['id'])
+
+    album.name = data['name']
+    album.image_url = data['image_url']
+    album.release_date = data['release_date']
+    album.artist_name = data['artists'][0]['name']
+    album.artist_id = data['artists'][0]['id']
+    album.fetched_at = datetime.now()
+
+    album.tracks = [
+        Track(
+            id=track['id'],
+            name=track['name'],
+            disc_number=track.get('disc_number', 1),
+            track_number=track['track_number'],
+            duration_ms=track['duration_ms']
+        ) for track in data['tracks']]
+
+    album.album_artists = [
+        AlbumArtist(artist_id=artist['id'], position=position)
+        for position, artist in enumerate(data['artists'])]
+
+    db.session.add(album)
+    db.session.commit()
+
+    return album
+
+
+@retry_on_conflict
+def store_artist(data):
+    """Adds or updates an artist from `spotify.get_artist_info` data and
+    returns the artist"""
+
+    artist = db.session.get(Artist, data['id']) or Artist(id=data['id'])
+
+    artist.name = data['name']
+    artist.image_url = data['image_url']
+    artist.spotify_link = data['spotify_link']
+    artist.genres = data['genres']
+    artist.fetched_at = datetime.now()
+
+    db.session.add(artist)
+    db.session.commit()
+
+    return artist
+
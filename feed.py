@@ -0,0 +1,359 @@
+import asyncio
+import select
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload
+
+from jobs import job_handler
+from models import db, Follow, FeedEvent, Rating, FEED_CHANNEL
+
+HEARTBEAT_INTERVAL = 15
+STREAM_BATCH_SIZE = 100
+FEED_EVENT_RETENTION = timedelta(days=7)
+LISTEN_RETRY_DELAY = 5
+STREAM_TOKEN_MAX_AGE = 300
+STREAM_TOKEN_SALT = 'feed-stream'
+
+RETRY_MESSAGE = "retry: 3000\n\n"
+KEEPALIVE_MESSAGE = ": keepalive\n\n"
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+class Subscription:
+    """An open stream, woken when one of the authors it follows has a new
+    feed event"""
+
+    def __init__(self, authors, wakeup=None):
+        self.authors = set(authors)
+        self.wakeup = wakeup or threading.Event()
+
+
+class AsyncWakeup:
+    """An asyncio event that the broker's threads can set, for streams served
+    on an event loop"""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    def clear(self):
+        self.event.clear()
+
+    async def wait(self, timeout):
+        """Waits until set or for `timeout` seconds, returns True if set"""
+
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        return True
+
+
+class MemoryBroker:
+    """Wakes the subscriptions of this process when authors publish"""
+
+    def __init__(self):
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self, authors, wakeup=None):
+        """Returns a new subscription to the given authors, woken through
+        `wakeup` if given"""
+
+        subscription = Subscription(authors, wakeup)
+
+        with self.lock:
+            self.subscriptions.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, authors):
+        """Wakes every subscription following any of the given authors"""
+
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+
+        for subscription in subscriptions:
+            if subscription.authors & authors:
+                subscription.wakeup.set()
+
+
+class PostgresBroker(MemoryBroker):
+    """Wakes the subscriptions of this process from PostgreSQL NOTIFY
+    messages, so ratings written by any worker reach every stream. A
+    background thread holds a dedicated connection listening on the feed
+    channel."""
+
+    def __init__(self, app, engine):
+        super().__init__()
+        self.app = app
+        self.engine = engine
+        self.thread = threading.Thread(target=self.listen, daemon=True,
+                                       name='feed-listener')
+        self.thread.start()
+
+    def listen(self):
+        """Publishes the authors of notifications as they arrive, reconnecting
+        after errors"""
+
+        while True:
+            connection = None
+            try:
+                connection = self.engine.raw_connection()
+                # Kept out of the pool, since it never goes back
+                connection.detach()
+                driver = connection.driver_connection
+                driver.autocommit = True
+                driver.cursor().execute(f"LISTEN {FEED_CHANNEL}")
+
+                while True:
+                    if select.select([driver], [], [], HEARTBEAT_INTERVAL)[0]:
+                        driver.poll()
+                        authors = {notify.payload for notify in driver.notifies}
+                        driver.notifies.clear()
+                        self.publish(authors)
+
+            except Exception:
+                self.app.logger.exception("Feed listener failed")
+
+                if connection is not None:
+                    connection.close()
+
+                time.sleep(LISTEN_RETRY_DELAY)
+
+
+def get_broker():
+    """Returns this process's broker, started on first use so it is created
+    after gunicorn forks. Uses PostgreSQL LISTEN/NOTIFY when the database
+    supports it, otherwise only ratings written by this process are
+    pushed."""
+
+    global _broker
+
+    with _broker_lock:
+        if _broker is None:
+            if db.engine.dialect.name == 'postgresql':
+                _broker = PostgresBroker(current_app._get_current_object(),
+                                         db.engine)
+            else:
+                _broker = MemoryBroker()
+
+        return _broker
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_committed_events(session):
+    """Publishes the authors of feed events recorded in a committed session to
+    the in-process broker"""
+
+    authors = session.info.pop('feed_authors', None)
+
+    if authors and _broker is not None:
+        _broker.publish(authors)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_rolled_back_events(session):
+    session.info.pop('feed_authors', None)
+
+
+def followed_authors(username):
+    """Returns the usernames whose ratings appear in a user's feed"""
+
+    return {username} | {
+        followed for (followed,) in db.session.query(
+            Follow.user_being_followed
+        ).filter(Follow.user_following == username)}
+
+
+def latest_event_id():
+    """Returns the position of the newest feed event, or 0 if there are
+    none"""
+
+    return db.session.query(db.func.max(FeedEvent.position)).scalar() or 0
+
+
+def events_after(last_id, authors, limit=STREAM_BATCH_SIZE):
+    """Returns feed events by the given authors positioned after `last_id`,
+    oldest first. Positions become visible in order, so none can appear
+    later behind the last one returned."""
+
+    return (FeedEvent.query
+            .options(joinedload(FeedEvent.rating).joinedload(Rating.album))
+            .filter(FeedEvent.position > last_id,
+                    FeedEvent.author.in_(authors))
+            .order_by(FeedEvent.position)
+            .limit(limit)
+            .all())
+
+
+def format_event(feed_event):
+    """Formats a feed event as a server-sent event"""
+
+    data = current_app.json.dumps(feed_event.serialize())
+
+    return f"id: {feed_event.position}\nevent: rating\ndata: {data}\n\n"
+
+
+def create_stream_token(username):
+    """Returns a signed token letting a user open their feed stream for the
+    next STREAM_TOKEN_MAX_AGE seconds. EventSource can't set headers, so it
+    goes in the URL, where the long lived login token must not."""
+
+    return URLSafeTimedSerializer(
+        current_app.config['SECRET_KEY'], salt=STREAM_TOKEN_SALT
+    ).dumps(username)
+
+
+def read_stream_token(token):
+    """Returns the username a stream token was issued to, or None if it is
+    invalid or expired"""
+
+    try:
+        return URLSafeTimedSerializer(
+            current_app.config['SECRET_KEY'], salt=STREAM_TOKEN_SALT
+        ).loads(token, max_age=STREAM_TOKEN_MAX_AGE)
+    except BadSignature:
+        return None
+
+
+def start_feed(username, last_id):
+    """Returns the authors in a user's feed and the event id to stream after,
+    the newest if `last_id` is None, releasing the database session"""
+
+    authors = followed_authors(username)
+
+    if last_id is None:
+        last_id = latest_event_id()
+
+    db.session.close()
+
+    return authors, last_id
+
+
+def read_feed(last_id, authors):
+    """Returns the server-sent events for a batch of feed events after
+    `last_id`, the id of the last one and whether the batch was full,
+    releasing the database session"""
+
+    events = events_after(last_id, authors)
+    chunk = ''.join(format_event(feed_event) for feed_event in events)
+    db.session.close()
+
+    if events:
+        last_id = events[-1].position
+
+    return chunk, last_id, len(events) == STREAM_BATCH_SIZE
+
+
+def refresh_authors(username):
+    """Returns the authors in a user's feed, releasing the database session"""
+
+    authors = followed_authors(username)
+    db.session.close()
+
+    return authors
+
+
+def stream_feed(username, last_id=None, max_duration=None):
+    """Yields server-sent events for new and edited ratings in a user's feed,
+    starting after `last_id`, or from now if it is None, for a WSGI server.
+    Sends a comment every HEARTBEAT_INTERVAL seconds, when it also rechecks
+    who the user follows, and ends after `max_duration` seconds if given so
+    the client reconnects. The database session is released while
+    waiting."""
+
+    broker = get_broker()
+    authors, last_id = start_feed(username, last_id)
+    subscription = broker.subscribe(authors)
+    deadline = max_duration and time.monotonic() + max_duration
+
+    try:
+        yield RETRY_MESSAGE
+
+        while not deadline or time.monotonic() < deadline:
+            subscription.wakeup.clear()
+
+            chunk, last_id, more = read_feed(last_id, authors)
+
+            if chunk:
+                yield chunk
+
+            if more:
+                continue
+
+            if not subscription.wakeup.wait(HEARTBEAT_INTERVAL):
+                yield KEEPALIVE_MESSAGE
+                subscription.authors = authors = refresh_authors(username)
+
+    finally:
+        broker.unsubscribe(subscription)
+        db.session.close()
+
+
+async def stream_feed_async(app, username, last_id=None):
+    """Yields the same server-sent events as `stream_feed` from an event
+    loop, so an open stream holds no thread while it waits. Its queries run
+    in worker threads with their own app context. Stops when the task
+    consuming it is cancelled, e.g. when the client disconnects."""
+
+    def run(f, *args):
+        def in_app_context():
+            with app.app_context():
+                return f(*args)
+
+        return asyncio.to_thread(in_app_context)
+
+    with app.app_context():
+        broker = get_broker()
+
+    authors, last_id = await run(start_feed, username, last_id)
+    subscription = broker.subscribe(authors, AsyncWakeup())
+
+    try:
+        yield RETRY_MESSAGE
+
+        while True:
+            subscription.wakeup.clear()
+
+            chunk, last_id, more = await run(read_feed, last_id, authors)
+
+            if chunk:
+                yield chunk
+
+            if more:
+                continue
+
+            if not await subscription.wakeup.wait(HEARTBEAT_INTERVAL):
+                yield KEEPALIVE_MESSAGE
+                subscription.authors = authors = await run(
+                    refresh_authors, username)
+
+    finally:
+        broker.unsubscribe(subscription)
+
+
+@job_handler('prune_feed_events')
+def prune_feed_events():
+    """Deletes feed events older than FEED_EVENT_RETENTION, which streams can
+    no longer be resumed from"""
+
+    FeedEvent.query.filter(
+        FeedEvent.created_at < datetime.now() - FEED_EVENT_RETENTION
+    ).delete()
+    db.session.commit()
@@ -0,0 +1,160 @@
+import importlib
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import or_, and_
+from sqlalchemy.dialects.postgresql import insert
+
+from models import (db, Job, User, UserStats, TrendingAlbum, RatingArchive,
+                    RATING_ARCHIVE_AGE)
+from quota import background_priority
+
+ACTIVE_STATUSES = ('pending', 'running')
+JOB_TIMEOUT = timedelta(minutes=10)
+MAX_RETRY_DELAY = timedelta(hours=1)
+
+HANDLERS = {}
+
+# Modules whose job handlers aren't loaded by the web app at startup
+HANDLER_MODULES = ('catalog', 'search', 'recommendations', 'feed')
+
+
+def job_handler(kind):
+    """Decorator registering a function as the handler of a kind of job. The
+    job's payload is passed to it as keyword arguments."""
+
+    def register(f):
+        HANDLERS[kind] = f
+        return f
+    return register
+
+
+def load_handlers():
+    """Imports every module that registers job handlers"""
+
+    for module in HANDLER_MODULES:
+        importlib.import_module(module)
+
+
+def enqueue(kind, payload=None, dedup_key=None, run_at=None):
+    """Adds a job to the session, skipping it if an unfinished job with the
+    same dedup key already exists. The caller commits. Returns True if the job
+    was added."""
+
+    result = db.session.execute(
+        insert(Job)
+        .values(
+            kind=kind,
+            payload=payload or {},
+            dedup_key=dedup_key,
+            run_at=run_at or datetime.now())
+        .on_conflict_do_nothing(
+            index_elements=['dedup_key'],
+            index_where=Job.status.in_(ACTIVE_STATUSES)))
+
+    return bool(result.rowcount)
+
+
+def claim_job():
+    """Locks the next due job with SELECT ... FOR UPDATE SKIP LOCKED so other
+    workers pass over it, marks it running and returns it. Jobs left running
+    longer than JOB_TIMEOUT by a crashed worker are claimed again. Returns None
+    if no job is due."""
+
+    now = datetime.now()
+
+    job = (Job.query
+           .filter(or_(
+               and_(Job.status == 'pending', Job.run_at <= now),
+               and_(Job.status == 'running', Job.locked_at < now - JOB_TIMEOUT)
+           ))
+           .order_by(Job.run_at)
+           .with_for_update(skip_locked=True)
+           .first())
+
+    if job:
+        job.status = 'running'
+        job.attempts += 1
+        job.locked_at = now
+
+    db.session.commit()
+
+    return job
+
+
+def run_job(job):
+    """Runs a claimed job with background spotify priority. Deletes it on
+    success, otherwise reschedules it with exponential backoff until it runs
+    out of attempts and is marked failed."""
+
+    try:
+        with background_priority():
+            HANDLERS[job.kind](**job.payload)
+
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("Job %s failed", job)
+
+        job.last_error = traceback.format_exc()
+        job.locked_at = None
+
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+        else:
+            job.status = 'pending'
+            job.run_at = datetime.now() + min(
+                timedelta(seconds=30 * 2 ** job.attempts), MAX_RETRY_DELAY)
+
+    else:
+        db.session.delete(job)
+
+    db.session.commit()
+
+
+def work(poll_interval=1.0, burst=False):
+    """Claims and runs due jobs forever, sleeping `poll_interval` seconds when
+    the queue is empty. In burst mode returns once the queue is empty."""
+
+    load_handlers()
+
+    while True:
+        job = claim_job()
+
+        if job:
+            run_job(job)
+        elif burst:
+            return
+        else:
+            time.sleep(poll_interval)
+
+
+@job_handler('rebuild_user_stats')
+def rebuild_user_stats(username=None):
+    """Recounts the stats of one user, or of every user if none is given"""
+
+    if username:
+        UserStats.rebuild(username)
+    else:
+        for (username,) in db.session.query(User.username).all():
+            UserStats.rebuild(username)
+
+    db.session.commit()
+
+
+@job_handler('compact_trending')
+def compact_trending():
+    """Rebuilds the trending album scores from the ratings table"""
+
+    TrendingAlbum.compact()
+
+
+@job_handler('archive_ratings')
+def archive_ratings(days=None):
+    """Moves ratings older than the given number of days, or
+    RATING_ARCHIVE_AGE, to the archive table. Returns the number moved."""
+
+    age = timedelta(days=days) if days else RATING_ARCHIVE_AGE
+
+    return RatingArchive.archive(datetime.now() - age)
@@ -0,0 +1,484 @@
+"""Template views and session login from before the app became a JSON API.
+Only imported and registered when LEGACY_VIEWS is set, so API workers don't
+load the forms."""
+
+from flask import Blueprint, render_template, session, redirect, flash, g, url_for, request, jsonify, get_template_attribute
+from models import db, User, Rating, Album, Follow
+from sqlalchemy.exc import IntegrityError
+from forms import LoginForm, SignupForm, CSRFProtectForm, EditRatingForm, AddRatingForm, EditUserForm, SearchForm
+from spotify import get_access_token, get_album_info, album_search, artist_search, get_artist_info, get_artists_albums
+from functools import wraps
+from datetime import datetime
+from math import floor
+
+legacy = Blueprint('legacy', __name__)
+
+CURR_USER_KEY = "active_user"
+
+################################### Helpers ####################################
+
+
+# Only run for the template views, so JSON API requests don't decode the
+# session and query the user, or build a CSRF form, for nothing
+@legacy.before_request
+def add_user_to_g():
+    """If we're logged in, add curr user to Flask global."""
+
+    if CURR_USER_KEY in session:
+        g.user = User.query.get(session[CURR_USER_KEY])
+
+    else:
+        g.user = None
+
+
+@legacy.before_request
+def add_csrfform_to_g():
+    """Add CSRF protection form to Flask global."""
+
+    g.csrf_form = CSRFProtectForm()
+
+
+def login_required(f):
+    """Decorator to make sure the user is logged in"""
+
+    @wraps(f)
+    def login_decorator(*args, **kwargs):
+        if not g.user:
+            flash("Access unauthorized.", "danger")
+            return redirect(url_for("legacy.handle_login_page"))
+        return f(*args, **kwargs)
+    return login_decorator
+
+
+def token_required(f):
+    """Decorator to make sure Spotify API token is still valid, generates new
+    one if not"""
+
+    @wraps(f)
+    def token_decorator(*args, **kwargs):
+        if hasattr(g, 'spotify_token'):
+            if g.spotify_token['exp_time'] > datetime.now():
+                return f(*args, **kwargs)
+
+        g.spotify_token = get_access_token()
+
+        return f(*args, **kwargs)
+    return token_decorator
+
+
+@legacy.app_template_filter()
+def format_runtime(milliseconds):
+    """Formats time in milliseconds to min:sec"""
+    total_sec = milliseconds / 1000
+    min = floor(total_sec / 60)
+    sec = floor(total_sec % 60)
+
+    if sec < 10:
+        sec_str = f'0{sec}'
+    else:
+        sec_str = f'{sec}'
+
+    return f'{min}:{sec_str}'
+
+
+def do_login(user):
+    """Log in user."""
+
+    session[CURR_USER_KEY] = user.username
+
+
+def do_logout():
+    """Log out user."""
+
+    if CURR_USER_KEY in session:
+        del session[CURR_USER_KEY]
+
+################################# Base Routes ##################################
+
+
+# @legacy.get('/')
+# def homepage():
+#     """Show homepage"""
+
+#     if not g.user:
+#         return redirect(url_for("handle_login_page"))
+
+#     home_rating_usernames = [
+#         user.username for user in g.user.following] + [g.user.username]
+
+#     ratings = (Rating
+#                .query
+#                .filter(
+#                    Rating.author.in_(home_rating_usernames)
+#                ).order_by(Rating.timestamp.desc())
+#                .limit(100)
+#                .all())
+
+#     return render_template('homepage.html', ratings=ratings)
+
+
+# @legacy.route('/login', methods=["GET", "POST"])
+# def handle_login_page():
+#     """Login user"""
+
+#     form = LoginForm()
+
+#     if form.validate_on_submit():
+#         user = User.login(
+#             username=form.username.data,
+#             password=form.password.data)
+
+#         if user:
+#             do_login(user)
+
+#             return redirect(url_for('homepage'))
+
+#         else:
+#             flash("Invalid Credentials", "danger")
+#             return redirect(url_for('handle_login_page'))
+
+#     return render_template('login.html', form=form)
+
+
+# @legacy.route('/signup', methods=["GET", "POST"])
+# def handle_signup_form():
+#     """Create new user and log them in"""
+
+#     form = SignupForm()
+
+#     if form.validate_on_submit():
+#         try:
+#             user = User.signup(
+#                 username=form.username.data,
+#                 first_name=form.first_name.data,
+#                 last_name=form.last_name.data or None,
+#                 password=form.password.data
+#             )
+
+#             db.session.commit()
+#             do_login(user)
+
+#             flash("User created successfully", "success")
+#             return redirect(url_for('show_user_page', username=user.username))
+
+#         except IntegrityError:
+#             flash("Username Taken.", "danger")
+#             return redirect(url_for('handle_signup_form', form=form))
+
+#     return render_template('signup.html', form=form)
+
+
+################################ Search Routes #################################
+
+
+# @legacy.get('/search')
+# @login_required
+# def search_items():
+#     """Loads search page template"""
+
+#     form = SearchForm(obj={
+#         'searchType': 'album',
+#         'search': None
+#     })
+
+#     return render_template('search.html', form=form)
+
+
+# @legacy.get('/search/results')
+# @login_required
+# @token_required
+# def get_search_results():
+#     """Takes search term, type, and offset in the query string and returns JSON
+#     of the results from the spotify API"""
+
+#     query = request.args.get("query", "a")
+#     search_type = request.args.get("type", "album")
+#     offset = request.args.get('offset')
+
+#     if search_type == "album":
+#         results = album_search(query=query, offset=offset,
+#                                token=g.spotify_token['token'])
+
+#     elif search_type == "artist":
+#         results = artist_search(
+#             query=query, offset=offset, token=g.spotify_token['token'])
+
+#     elif search_type == "user":
+#         unserialized_results = User.search(search=query, offset=offset)
+#         results = [user.serialize() for user in unserialized_results]
+
+#     return jsonify(results)
+
+
+################################# User Routes ##################################
+
+
+# @legacy.get('/users/<username>')
+# @login_required
+# def show_user_page(username):
+#     """Show specific user page"""
+
+#     user = User.query.get_or_404(username)
+
+#     return render_template('userPage.html', user=user)
+
+
+# @legacy.get('/users/following/<username>')
+# @jwt_required()
+# def is_user_following(username):
+#     """Returns JSON of true or false stating if the current user is following
+#     the given user"""
+
+#     user = User.query.get_or_404(username)
+#     curr_user = User.query.get(get_jwt_identity()["username"])
+
+#     return jsonify({"answer": curr_user.is_following(user)})
+
+
+# @legacy.route('/edit-user', methods=["GET", "POST"])
+# @login_required
+# def handle_edit_user_form():
+#     """Edit user"""
+
+#     form = EditUserForm(obj=g.user)
+#     db.session.rollback()
+
+#     if form.validate_on_submit():
+#         try:
+#             g.user.first_name = form.first_name.data
+#             g.user.last_name = form.last_name.data or None
+#             g.user.bio = form.bio.data or None
+#             g.user.image_url = form.image_url.data or DEFAULT_USER_IMAGE
+
+#             db.session.commit()
+
+#             return redirect(url_for('show_user_page', username=g.user.username))
+
+#         except ValueError:
+#             flash("Username Taken.", "danger")
+#             return redirect(url_for('handle_edit_user_form', form=form))
+
+#     return render_template('editUserForm.html', form=form)
+
+
+# @legacy.post('/follow-user/<username>')
+# @login_required
+# def handle_user_follow(username):
+#     """Follows user if not already following, unfollows if they are"""
+
+#     user = User.query.get_or_404(username)
+
+#     if g.user.is_following(user):
+#         g.user.following.remove(user)
+
+#     else:
+#         g.user.following.append(user)
+
+#     db.session.commit()
+
+#     return redirect(url_for('show_user_page', username=username))
+
+
+# @legacy.post('/logout')
+# @login_required
+# def logout_user():
+#     """Logs user out"""
+
+#     if not g.csrf_form.validate_on_submit():
+#         flash("Access unauthorized.", "danger")
+#         return redirect("/")
+
+#     do_logout()
+#     return redirect(url_for('handle_login_page'))
+
+
+# @legacy.post('/delete-user')
+# @login_required
+# def delete_user():
+#     """Deletes current signed in user"""
+
+#     if not g.csrf_form.validate_on_submit():
+#         flash("Access unauthorized.", "danger")
+#         return redirect("/")
+
+#     do_logout()
+#     g.user.delete_user()
+#     db.session.commit()
+#     return redirect(url_for('handle_signup_form'))
+
+
+################################# Music Routes #################################
+
+
+# @legacy.get('/artists/<artist_id>')
+# @login_required
+# @token_required
+# def show_artist_page(artist_id):
+#     """Shows specific artist page"""
+
+#     artist = get_artist_info(artist_id, token=g.spotify_token['token'])
+
+#     return render_template('artistPage.html', artist=artist)
+
+
+# @legacy.get('/albums/<album_id>')
+# @login_required
+# @token_required
+# def show_album(album_id):
+#     """Show individual album page"""
+
+#     album = get_album_info(album_id, g.spotify_token['token'])
+
+#     ratings = Rating.query.filter_by(album_id=album_id).all()
+
+#     return render_template("albumPage.html", album=album, ratings=ratings)
+
+
+# @legacy.get('/artists/<artist_id>/albums')
+# @login_required
+# @token_required
+# def request_artists_albums(artist_id):
+#     """Takes an artist id as a parameter and an offset amount as a query string
+#     and returns JSON of that artists albums"""
+
+#     offset = request.args.get('offset', 0)
+
+#     albums = get_artists_albums(
+#         artist_id=artist_id,
+#         offset=offset,
+#         token=g.spotify_token['token']
+#     )
+
+#     return jsonify(albums)
+
+
+################################ Rating Routes #################################
+
+
+# @legacy.route('/rate-album/<album_id>', methods=["GET", "POST"])
+# @login_required
+# @token_required
+# def handle_rating_form(album_id):
+#     """Create new album rating"""
+
+#     form = AddRatingForm()
+
+#     album = get_album_info(album_id, g.spotify_token['token'])
+#     rating = Rating.query.filter_by(
+#         album_id=album_id, author=g.user.username).one_or_none()
+
+#     song_choices = [(song['name'], song['name']) for song in album['tracks']]
+#     song_choices.insert(0, ('', ''))
+#     form.favorite_song.choices = song_choices
+
+#     if rating:
+#         flash("Redirected to edit previous rating", "warning")
+#         return redirect(url_for('edit_rating', album_id=album_id))
+
+#     if form.validate_on_submit():
+#         rating = Rating(
+#             rating=form.rating.data,
+#             text=form.text.data,
+#             favorite_song=form.favorite_song.data,
+#             timestamp=datetime.now(),
+#             album_id=album_id,
+#             author=g.user.username
+#         )
+
+#         db_album = Album.query.get(album_id)
+
+#         if not db_album:
+#             db_album = Album(
+#                 id=album['id'],
+#                 name=album['name'],
+#                 image_url=album['image_url'],
+#                 artist_name=album['artists'][0]['name'],
+#                 artist_id=album['artists'][0]['id']
+#             )
+
+#             db.session.add(db_album)
+
+#         db.session.add(rating)
+#         db.session.commit()
+
+#         return redirect(url_for('show_album', album_id=album_id))
+
+#     return render_template('addRatingForm.html', form=form, album=album)
+
+
+# @legacy.route('/edit-rating/<album_id>', methods=["GET", "POST"])
+# @login_required
+# @token_required
+# def edit_rating(album_id):
+#     """Edit a user's preexisting album rating"""
+
+#     album = get_album_info(album_id, g.spotify_token['token'])
+#     rating = Rating.query.filter_by(
+#         album_id=album_id, author=g.user.username).one_or_404()
+
+#     form = EditRatingForm(obj=rating)
+
+#     song_choices = [(song['name'], song['name']) for song in album['tracks']]
+#     song_choices.insert(0, ('', ''))
+#     form.favorite_song.choices = song_choices
+
+#     if form.validate_on_submit():
+#         rating.rating = form.rating.data
+#         rating.text = form.text.data
+#         rating.favorite_song = form.favorite_song.data
+
+#         db.session.commit()
+
+#         return redirect(url_for('show_album', album_id=album_id))
+
+#     return render_template('editRatingForm.html', form=form, album=album)
+
+
+# @legacy.post('/delete-rating/<int:rating_id>')
+# @login_required
+# def delete_rating(rating_id):
+#     """Delete a rating"""
+
+#     rating = Rating.query.get_or_404(rating_id)
+
+#     if not g.csrf_form.validate_on_submit():
+#         flash("Access unauthorized.", "danger")
+#         return redirect("/")
+
+#     db.session.delete(rating)
+#     db.session.commit()
+
+#     return redirect(url_for('show_album', album_id=rating.album_id))
+
+
+# @legacy.get('/ratings/load')
+# @login_required
+# def load_ratings():
+#     """Takes information about the ratings to show in the query string and
+#     returns JSON of the html for those ratings"""
+
+#     user = request.args.get('user', '')
+#     album_id = request.args.get('albumId', '')
+#     homepage = request.args.get('homepage')
+#     offset = request.args.get('offset', 0)
+
+#     if homepage:
+#         usernames = [user.username for user in g.user.following] + \
+#             [g.user.username]
+#     else:
+#         usernames = [user]
+
+#     ratings = (Rating
+#                .query
+#                .filter(or_(
+#                    Rating.author.in_(usernames),
+#                    Rating.album_id == album_id
+#                )).order_by(Rating.timestamp.desc())
+#                .limit(10)
+#                .offset(offset)
+#                .all())
+
+#     get_rating_html = get_template_attribute('rating.html', 'show_rating')
+#     rating_htmls = [get_rating_html(rating) for rating in ratings]
+
+#     return jsonify(rating_htmls)
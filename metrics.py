@@ -0,0 +1,71 @@
+from collections import defaultdict, deque
+from threading import Lock
+
+SAMPLE_SIZE = 1000
+
+_lock = Lock()
+_counters = defaultdict(int)
+_summaries = {}
+
+
+class Summary:
+    """Count, total and maximum of observed values, plus a window of recent
+    samples for percentiles"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+    def observe(self, value):
+        """Adds a value to the summary"""
+
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def serialize(self):
+        """Returns a dictionary of the summary statistics"""
+
+        samples = sorted(self.samples)
+
+        def percentile(p):
+            """Returns the value below which a fraction p of samples fall"""
+            return samples[min(int(p * len(samples)), len(samples) - 1)]
+
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'p50': percentile(0.5) if samples else 0,
+            'p95': percentile(0.95) if samples else 0,
+            'p99': percentile(0.99) if samples else 0
+        }
+
+
+def increment(name, amount=1):
+    """Adds to a counter"""
+
+    with _lock:
+        _counters[name] += amount
+
+
+def observe(name, value):
+    """Records a value, such as a wait time in seconds, in a summary"""
+
+    with _lock:
+        _summaries.setdefault(name, Summary()).observe(value)
+
+
+def snapshot():
+    """Returns a dictionary of every counter and summary in this process"""
+
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'summaries': {
+                name: summary.serialize()
+                for name, summary in _summaries.items()}
+        }
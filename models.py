@@ -1,7 +1,13 @@
+import math
+
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import or_
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, declared_attr, joinedload, object_session
+from sqlalchemy.dialects.postgresql import insert
 from flask_bcrypt import Bcrypt
-from datetime import datetime
+from datetime import datetime, timedelta
 
 db = SQLAlchemy()
 bcrypt = Bcrypt()
@@ -9,15 +15,65 @@ bcrypt = Bcrypt()
 DEFAULT_USER_IMAGE = (
     "https://braverplayers.org/wp-content/uploads/2022/09/blank-pfp.png")
 
+# Decay time constant of each trending window, None never decays
+TRENDING_WINDOWS = {
+    '24h': timedelta(hours=24),
+    '7d': timedelta(days=7),
+    'all': None
+}
+TRENDING_EPOCH = datetime(2024, 1, 1)
+
+# PostgreSQL NOTIFY channel announcing the authors of new feed events
+FEED_CHANNEL = 'feed_events'
+# PostgreSQL advisory lock held while numbering feed events at commit
+FEED_POSITION_LOCK = 7265011
+
+# Ratings older than this are moved to the archive table
+RATING_ARCHIVE_AGE = timedelta(days=365)
+ARCHIVE_BATCH_SIZE = 10000
+
+# Columns and indexes added to tables that predate them, which create_all
+# leaves alone. Each statement can be rerun.
+SCHEMA_UPGRADES = (
+    "ALTER TABLE albums ADD COLUMN IF NOT EXISTS release_date VARCHAR(10)",
+    "ALTER TABLE albums ADD COLUMN IF NOT EXISTS fetched_at TIMESTAMP",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ratings_author_timestamp "
+    "ON ratings (author, timestamp)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ratings_album_id_timestamp "
+    "ON ratings (album_id, timestamp)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ratings_timestamp "
+    "ON ratings (timestamp)",
+    "ALTER TABLE feed_events ADD COLUMN IF NOT EXISTS position BIGINT",
+    "UPDATE feed_events SET position = id WHERE position IS NULL",
+    "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_feed_events_position "
+    "ON feed_events (position)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_feed_events_author_position "
+    "ON feed_events (author, position)",
+    "DROP INDEX CONCURRENTLY IF EXISTS ix_feed_events_author_id",
+)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app. Called in app.py"""
 
-    app.app_context().push()
     db.app = app
     db.init_app(app)
 
 
+def upgrade_db():
+    """Creates missing tables, then makes the SCHEMA_UPGRADES to tables that
+    already existed. The indexes are built concurrently, without blocking
+    writes. Safe to rerun, though a build that failed leaves an invalid index
+    to drop first."""
+
+    db.create_all()
+
+    with db.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as connection:
+        for statement in SCHEMA_UPGRADES:
+            connection.execute(db.text(statement))
+
+
 class Follow(db.Model):
     """Follower/following table"""
 
@@ -37,6 +93,73 @@ class Follow(db.Model):
         nullable=False
     )
 
+    @classmethod
+    def exists(cls, follower, followed):
+        """Checks if the follower username follows the followed username using
+        a primary key lookup"""
+
+        return db.session.get(cls, (followed, follower)) is not None
+
+    @classmethod
+    def add(cls, follower, followed):
+        """Inserts the follow relationship if it does not already exist and
+        updates both users' counts. Returns True if a row was inserted."""
+
+        result = db.session.execute(
+            insert(cls)
+            .values(user_being_followed=followed, user_following=follower)
+            .on_conflict_do_nothing())
+
+        if result.rowcount:
+            UserStats.adjust(followed, follower_count=1)
+            UserStats.adjust(follower, following_count=1)
+            CacheVersion.bump([follows_version_key(follower)])
+
+        return bool(result.rowcount)
+
+    @classmethod
+    def remove(cls, follower, followed):
+        """Deletes the follow relationship if it exists and updates both users'
+        counts. Returns True if a row was deleted."""
+
+        result = db.session.execute(
+            db.delete(cls)
+            .where(cls.user_being_followed == followed,
+                   cls.user_following == follower))
+
+        if result.rowcount:
+            UserStats.adjust(followed, follower_count=-1)
+            UserStats.adjust(follower, following_count=-1)
+            CacheVersion.bump([follows_version_key(follower)])
+
+        return bool(result.rowcount)
+
+    @classmethod
+    def add_many(cls, follower, followed_usernames):
+        """Follows every existing user in the given list of usernames in a
+        single statement, skipping existing follows, unknown usernames and the
+        follower themself. Returns the list of newly followed usernames."""
+
+        existing_users = (db.select(User.username, db.literal(follower))
+                          .where(User.username.in_(followed_usernames),
+                                 User.username != follower))
+
+        result = db.session.execute(
+            insert(cls)
+            .from_select(['user_being_followed', 'user_following'],
+                         existing_users)
+            .on_conflict_do_nothing()
+            .returning(cls.user_being_followed))
+
+        followed = result.scalars().all()
+
+        if followed:
+            UserStats.adjust_many(followed, follower_count=1)
+            UserStats.adjust(follower, following_count=len(followed))
+            CacheVersion.bump([follows_version_key(follower)])
+
+        return followed
+
 
 class User(db.Model):
     """Users of the app"""
@@ -112,6 +235,16 @@ class User(db.Model):
         """Deletes current user and all their ratings and followings"""
 
         Rating.query.filter_by(author=self.username).delete()
+
+        UserStats.adjust_many(
+            db.select(Follow.user_following)
+            .where(Follow.user_being_followed == self.username),
+            following_count=-1)
+        UserStats.adjust_many(
+            db.select(Follow.user_being_followed)
+            .where(Follow.user_following == self.username),
+            follower_count=-1)
+
         Follow.query.filter(
             or_(
                 Follow.user_following == self.username,
@@ -139,6 +272,7 @@ class User(db.Model):
         )
 
         db.session.add(user)
+        db.session.add(UserStats(username=username))
         return user
 
     @classmethod
@@ -173,18 +307,9 @@ class User(db.Model):
         return users
 
 
-class Rating(db.Model):
-    """User's ratings of albums"""
-
-    __tablename__ = "ratings"
-
-    __table_args__ = (db.UniqueConstraint('album_id', 'author'),)
-
-    id = db.Column(
-        db.Integer,
-        primary_key=True,
-        autoincrement=True
-    )
+class RatingColumns:
+    """Columns and serialization shared by ratings and archived ratings, so
+    the two tables can't drift apart"""
 
     rating = db.Column(
         db.Float,
@@ -204,20 +329,24 @@ class Rating(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.now(),
+        default=datetime.now,
     )
 
-    album_id = db.Column(
-        db.String(30),
-        db.ForeignKey("albums.id", ondelete="cascade"),
-        nullable=False
-    )
+    @declared_attr
+    def album_id(cls):
+        return db.Column(
+            db.String(30),
+            db.ForeignKey("albums.id", ondelete="cascade"),
+            nullable=False
+        )
 
-    author = db.Column(
-        db.String(20),
-        db.ForeignKey('users.username', ondelete="cascade"),
-        nullable=False
-    )
+    @declared_attr
+    def author(cls):
+        return db.Column(
+            db.String(20),
+            db.ForeignKey('users.username', ondelete="cascade"),
+            nullable=False
+        )
 
     def serialize(self):
         """Returns a dictionary of the information about the rating"""
@@ -233,6 +362,169 @@ class Rating(db.Model):
         }
 
 
+class Rating(RatingColumns, db.Model):
+    """User's ratings of albums"""
+
+    __tablename__ = "ratings"
+
+    __table_args__ = (
+        db.UniqueConstraint('album_id', 'author'),
+        db.Index('ix_ratings_author_timestamp', 'author', 'timestamp'),
+        db.Index('ix_ratings_album_id_timestamp', 'album_id', 'timestamp'),
+        db.Index('ix_ratings_timestamp', 'timestamp'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+
+    @classmethod
+    def upsert(cls, author, album_id, rating, favorite_song=None, text=""):
+        """Creates the author's rating of an album, or updates it if they have
+        already rated it, with a single INSERT ... ON CONFLICT DO UPDATE that
+        is safe against concurrent submissions. The same statement deletes an
+        archived rating to restore it. Core statements skip the ORM
+        events, so the stats, trending scores, cache versions and feed event
+        are written here.
+        An archived rating is moved back, keeping its id, and counts as
+        updated. It is stamped with the current time, since the rating pages
+        only read the archive past the end of the ratings table. The caller
+        commits. Returns the rating, read back with its album by the same
+        statement and detached from the session, and True if it was
+        created."""
+
+        archived = (db.delete(RatingArchive)
+                    .where(RatingArchive.album_id == album_id,
+                           RatingArchive.author == author)
+                    .returning(RatingArchive.id)
+                    .cte('archived'))
+        archived_id = db.select(archived.c.id).scalar_subquery()
+
+        # An archived rating keeps its id, a new one takes the next in the
+        # ratings sequence as its default would
+        rating_id = db.func.coalesce(archived_id, db.func.nextval(
+            db.func.pg_get_serial_sequence(cls.__tablename__, 'id')))
+
+        statement = insert(cls).from_select(
+            ['id', 'author', 'album_id', 'rating', 'favorite_song', 'text',
+             'timestamp'],
+            db.select(rating_id, db.literal(author), db.literal(album_id),
+                      db.literal(rating, db.Float),
+                      db.literal(favorite_song, db.Text),
+                      db.literal(text, db.Text),
+                      db.literal(datetime.now(), db.DateTime)))
+
+        upserted = (statement
+                    .on_conflict_do_update(
+                        index_elements=['album_id', 'author'],
+                        set_={
+                            'rating': statement.excluded.rating,
+                            'favorite_song': statement.excluded.favorite_song,
+                            'text': statement.excluded.text
+                        })
+                    # xmax is only zero for rows this statement inserted
+                    .returning(*cls.__table__.c,
+                               (db.literal_column('xmax') == 0)
+                               .label('created'))
+                    .cte('upserted'))
+
+        row = db.session.execute(
+            db.select(upserted, archived_id.label('archived_id'), Album.name,
+                      Album.image_url, Album.artist_name, Album.artist_id)
+            .join(Album, Album.id == upserted.c.album_id)).one()
+
+        created = row.created and row.archived_id is None
+
+        if created:
+            UserStats.adjust(author, rating_count=1)
+            TrendingAlbum.add_rating(album_id, row.timestamp)
+        else:
+            UserStats.invalidate_analytics(author)
+
+        CacheVersion.bump(rating_version_keys(author, album_id))
+
+        FeedEvent.record(row.id, author, 'created' if created else 'updated',
+                         db.session.connection(), session=db.session())
+
+        album = Album(id=album_id, name=row.name, image_url=row.image_url,
+                      artist_name=row.artist_name, artist_id=row.artist_id)
+
+        return cls(id=row.id, rating=row.rating,
+                   favorite_song=row.favorite_song, text=row.text,
+                   timestamp=row.timestamp, album_id=album_id, author=author,
+                   album=album), created
+
+
+class RatingArchive(RatingColumns, db.Model):
+    """Ratings older than RATING_ARCHIVE_AGE, moved out of the ratings table so
+    its indexes stay small and hot. Rows keep the id they had as ratings."""
+
+    __tablename__ = "ratings_archive"
+
+    __table_args__ = (
+        db.UniqueConstraint('album_id', 'author'),
+        db.Index('ix_ratings_archive_author_timestamp', 'author', 'timestamp'),
+        db.Index('ix_ratings_archive_album_id_timestamp',
+                 'album_id', 'timestamp'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False
+    )
+
+    album = db.relationship("Album")
+
+    @classmethod
+    def archive(cls, before, batch_size=ARCHIVE_BATCH_SIZE):
+        """Moves ratings made before the given time into the archive in
+        batches. Each batch is one statement, a DELETE ... RETURNING feeding
+        an INSERT, so no rating is lost or copied twice, and commits. Ratings
+        counts are left alone since archived ratings still count. Returns the
+        number of ratings moved."""
+
+        columns = [column.name for column in cls.__table__.columns]
+        moved_count = 0
+
+        while True:
+            batch = (db.select(Rating.id)
+                     .where(Rating.timestamp < before)
+                     .limit(batch_size))
+
+            moved = (db.delete(Rating)
+                     .where(Rating.id.in_(batch.scalar_subquery()))
+                     .returning(*(Rating.__table__.c[column]
+                                  for column in columns))
+                     .cte('moved'))
+
+            result = db.session.execute(
+                insert(cls)
+                .from_select(columns, db.select(moved))
+                .add_cte(moved))
+            db.session.commit()
+
+            moved_count += result.rowcount
+
+            if result.rowcount < batch_size:
+                return moved_count
+
+
+def all_ratings():
+    """Returns a subquery of the ratings and archived ratings together, for
+    statistics over the whole rating history. Filters on it are pushed down
+    into both tables."""
+
+    columns = ['id', 'rating', 'timestamp', 'album_id', 'author']
+
+    return db.union_all(
+        db.select(*(Rating.__table__.c[column] for column in columns)),
+        db.select(*(RatingArchive.__table__.c[column] for column in columns))
+    ).subquery('all_ratings')
+
+
 class Album(db.Model):
     """Albums that have been reviewed on the app"""
 
@@ -264,6 +556,14 @@ class Album(db.Model):
         nullable=False
     )
 
+    release_date = db.Column(
+        db.String(10)
+    )
+
+    fetched_at = db.Column(
+        db.DateTime
+    )
+
     def serialize(self):
         """Returns a dictionary of the information about the album"""
 
@@ -275,4 +575,1020 @@ class Album(db.Model):
             'artistId': self.artist_id
         }
 
+    def to_info(self):
+        """Returns a dictionary of the album in the same shape as
+        `spotify.get_album_info`"""
+
+        return {
+            'id': self.id,
+            'name': self.name,
+            'image_url': self.image_url,
+            'release_date': self.release_date,
+            'tracks': [track.to_info() for track in self.tracks],
+            'artists': [{
+                'name': album_artist.artist.name,
+                'id': album_artist.artist_id
+            } for album_artist in self.album_artists] or [{
+                'name': self.artist_name,
+                'id': self.artist_id
+            }]
+        }
+
     ratings = db.relationship("Rating", backref="album")
+
+    tracks = db.relationship(
+        "Track",
+        order_by="(Track.disc_number, Track.track_number)",
+        cascade="all, delete-orphan"
+    )
+
+    album_artists = db.relationship(
+        "AlbumArtist",
+        order_by="AlbumArtist.position",
+        cascade="all, delete-orphan"
+    )
+
+
+class Artist(db.Model):
+    """Local copy of Spotify artist data"""
+
+    __tablename__ = "artists"
+
+    id = db.Column(
+        db.String(30),
+        primary_key=True,
+        nullable=False
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False
+    )
+
+    image_url = db.Column(
+        db.String(255)
+    )
+
+    spotify_link = db.Column(
+        db.String(255)
+    )
+
+    genres = db.Column(
+        db.JSON,
+        nullable=False,
+        default=list
+    )
+
+    fetched_at = db.Column(
+        db.DateTime
+    )
+
+    def to_info(self):
+        """Returns a dictionary of the artist in the same shape as
+        `spotify.get_artist_info`"""
+
+        return {
+            'name': self.name,
+            'image_url': self.image_url,
+            'id': self.id,
+            'spotify_link': self.spotify_link,
+            'genres': self.genres
+        }
+
+
+class AlbumArtist(db.Model):
+    """Artists credited on an album, in credit order"""
+
+    __tablename__ = "album_artists"
+
+    album_id = db.Column(
+        db.String(30),
+        db.ForeignKey("albums.id", ondelete="cascade"),
+        primary_key=True,
+        nullable=False
+    )
+
+    artist_id = db.Column(
+        db.String(30),
+        db.ForeignKey("artists.id", ondelete="cascade"),
+        primary_key=True,
+        nullable=False,
+        index=True
+    )
+
+    position = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    artist = db.relationship("Artist", lazy="joined")
+
+
+class Track(db.Model):
+    """Local copy of the tracks of an album"""
+
+    __tablename__ = "tracks"
+
+    id = db.Column(
+        db.String(30),
+        primary_key=True,
+        nullable=False
+    )
+
+    album_id = db.Column(
+        db.String(30),
+        db.ForeignKey("albums.id", ondelete="cascade"),
+        nullable=False,
+        index=True
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False
+    )
+
+    disc_number = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1
+    )
+
+    track_number = db.Column(
+        db.Integer,
+        nullable=False
+    )
+
+    duration_ms = db.Column(
+        db.Integer,
+        nullable=False
+    )
+
+    def to_info(self):
+        """Returns a dictionary of the track with the Spotify track fields the
+        app uses"""
+
+        return {
+            'id': self.id,
+            'name': self.name,
+            'disc_number': self.disc_number,
+            'track_number': self.track_number,
+            'duration_ms': self.duration_ms
+        }
+
+
+class UserStats(db.Model):
+    """Denormalized counts and cached serialized profile for a user. Counts are
+    maintained on follow, unfollow and rating changes so a profile view is a
+    single primary key lookup"""
+
+    __tablename__ = "user_stats"
+
+    username = db.Column(
+        db.String(20),
+        db.ForeignKey('users.username', ondelete='cascade'),
+        primary_key=True,
+        nullable=False
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    rating_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1
+    )
+
+    profile = db.Column(
+        db.JSON
+    )
+
+    analytics = db.Column(
+        db.JSON
+    )
+
+    def serialize(self):
+        """Returns a dictionary of the cached profile merged with the counts"""
+
+        return {
+            **self.profile,
+            'followerCount': self.follower_count,
+            'followingCount': self.following_count,
+            'ratingCount': self.rating_count
+        }
+
+    @classmethod
+    def get_profile(cls, username):
+        """Returns the stats row for the given username with its profile cache
+        filled in, rebuilding it if it is missing or has been invalidated.
+        Returns None if the user does not exist. The row is detached, keeping
+        the version the profile was read at."""
+
+        stats = db.session.get(cls, username)
+
+        if stats and stats.profile is not None:
+            return stats
+
+        if not stats:
+            stats = cls.add_missing(username)
+
+            if not stats:
+                return None
+
+        # Read before the user, so an edit committed in between is detected
+        version = stats.version
+        user = db.session.get(User, username)
+
+        if not user:
+            return None
+
+        db.session.expunge(stats)
+        stats.profile = user.serialize()
+
+        cls.fill(username, version, profile=stats.profile)
+        db.session.commit()
+
+        return stats
+
+    @classmethod
+    def add_missing(cls, username):
+        """Adds and commits a stats row for a user who has none, e.g. one who
+        signed up before stats were kept. Returns the row, which a concurrent
+        request may have added first, or None if the user does not exist."""
+
+        if not db.session.get(User, username):
+            return None
+
+        try:
+            cls.rebuild(username)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+        return db.session.get(cls, username)
+
+    @classmethod
+    def fill(cls, username, version, **values):
+        """Stores computed values in the empty cache columns of a user's stats
+        row, unless a write has bumped its version since it was read at
+        `version`, so an invalidation committed while they were computed is
+        never overwritten with stale values"""
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.username == username, cls.version == version,
+                   *(getattr(cls, column).is_(None) for column in values))
+            .values(**values))
+
+    @classmethod
+    def rebuild(cls, username):
+        """Recounts followers, followings and ratings for the given username
+        and adds or updates their stats row"""
+
+        stats = db.session.get(cls, username) or cls(username=username)
+
+        stats.follower_count = Follow.query.filter_by(
+            user_being_followed=username).count()
+        stats.following_count = Follow.query.filter_by(
+            user_following=username).count()
+        stats.rating_count = (
+            Rating.query.filter_by(author=username).count() +
+            RatingArchive.query.filter_by(author=username).count())
+        stats.version = (stats.version or 0) + 1
+
+        db.session.add(stats)
+        return stats
+
+    @classmethod
+    def adjust(cls, username, connection=None, **deltas):
+        """Atomically adds the given deltas to the count columns of a user's
+        stats row and bumps its version"""
+
+        cls.adjust_many([username], connection=connection, **deltas)
+
+    @classmethod
+    def adjust_many(cls, usernames, connection=None, **deltas):
+        """Atomically adds the given deltas to the count columns of each of the
+        given usernames (a list or a subquery) and bumps their versions. Clears
+        their cached analytics if their rating counts change."""
+
+        values = {
+            column: getattr(cls, column) + delta
+            for column, delta in deltas.items()
+        }
+        values['version'] = cls.version + 1
+
+        if 'rating_count' in deltas:
+            values['analytics'] = None
+
+        statement = (db.update(cls)
+                     .where(cls.username.in_(usernames))
+                     .values(**values))
+
+        (connection or db.session).execute(statement)
+
+    @classmethod
+    def invalidate_profile(cls, username):
+        """Clears the cached profile of a user so it is rebuilt on next view"""
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.username == username)
+            .values(profile=None, version=cls.version + 1))
+
+    @classmethod
+    def invalidate_analytics(cls, username, connection=None):
+        """Clears the cached analytics of a user so they are recomputed on next
+        view, bumping the version so a computation in progress isn't
+        stored"""
+
+        (connection or db.session).execute(
+            db.update(cls)
+            .where(cls.username == username)
+            .values(analytics=None, version=cls.version + 1))
+
+
+@event.listens_for(Rating, "after_insert")
+def count_new_rating(mapper, connection, rating):
+    """Increments the author's rating count and the album's trending scores
+    when a rating is added"""
+
+    UserStats.adjust(rating.author, connection=connection, rating_count=1)
+    CacheVersion.bump(rating_version_keys(rating.author, rating.album_id),
+                      connection=connection)
+    TrendingAlbum.add_rating(rating.album_id, rating.timestamp,
+                             connection=connection)
+    FeedEvent.record(rating.id, rating.author, 'created', connection,
+                     session=object_session(rating))
+
+
+@event.listens_for(Rating, "after_update")
+def record_edited_rating(mapper, connection, rating):
+    """Clears the author's cached analytics, invalidates cached rating lists
+    and adds a feed event when a rating is edited"""
+
+    UserStats.invalidate_analytics(rating.author, connection=connection)
+    CacheVersion.bump(rating_version_keys(rating.author, rating.album_id),
+                      connection=connection)
+    FeedEvent.record(rating.id, rating.author, 'updated', connection,
+                     session=object_session(rating))
+
+
+@event.listens_for(Rating, "after_delete")
+def count_deleted_rating(mapper, connection, rating):
+    """Decrements the author's rating count when a rating is deleted"""
+
+    UserStats.adjust(rating.author, connection=connection, rating_count=-1)
+    CacheVersion.bump(rating_version_keys(rating.author, rating.album_id),
+                      connection=connection)
+
+
+class UserRecommendation(db.Model):
+    """Precomputed users recommended for a user to follow, ranked by score"""
+
+    __tablename__ = "user_recommendations"
+
+    __table_args__ = (db.Index('ix_user_recommendations_username_rank',
+                               'username', 'rank'),)
+
+    username = db.Column(
+        db.String(20),
+        db.ForeignKey('users.username', ondelete='cascade'),
+        primary_key=True,
+        nullable=False
+    )
+
+    recommended_username = db.Column(
+        db.String(20),
+        db.ForeignKey('users.username', ondelete='cascade'),
+        primary_key=True,
+        nullable=False
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False
+    )
+
+    rank = db.Column(
+        db.Integer,
+        nullable=False
+    )
+
+    recommended_user = db.relationship(
+        'User', foreign_keys=[recommended_username])
+
+    def serialize(self):
+        """Returns a dictionary of the recommended user and their score"""
+
+        return {
+            'user': self.recommended_user.serialize(),
+            'score': self.score
+        }
+
+
+class SimilarAlbum(db.Model):
+    """Precomputed albums most similar to an album by rating patterns"""
+
+    __tablename__ = "similar_albums"
+
+    __table_args__ = (db.Index('ix_similar_albums_album_id_rank',
+                               'album_id', 'rank'),)
+
+    album_id = db.Column(
+        db.String(30),
+        db.ForeignKey("albums.id", ondelete="cascade"),
+        primary_key=True,
+        nullable=False
+    )
+
+    similar_album_id = db.Column(
+        db.String(30),
+        db.ForeignKey("albums.id", ondelete="cascade"),
+        primary_key=True,
+        nullable=False
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False
+    )
+
+    rank = db.Column(
+        db.Integer,
+        nullable=False
+    )
+
+    similar_album = db.relationship('Album', foreign_keys=[similar_album_id])
+
+    def serialize(self):
+        """Returns a dictionary of the similar album and its score"""
+
+        return {
+            'album': self.similar_album.serialize(),
+            'score': self.score
+        }
+
+
+class AlbumRecommendation(db.Model):
+    """Precomputed albums recommended to a user, ranked by score"""
+
+    __tablename__ = "album_recommendations"
+
+    __table_args__ = (db.Index('ix_album_recommendations_username_rank',
+                               'username', 'rank'),)
+
+    username = db.Column(
+        db.String(20),
+        db.ForeignKey('users.username', ondelete='cascade'),
+        primary_key=True,
+        nullable=False
+    )
+
+    album_id = db.Column(
+        db.String(30),
+        db.ForeignKey("albums.id", ondelete="cascade"),
+        primary_key=True,
+        nullable=False
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False
+    )
+
+    rank = db.Column(
+        db.Integer,
+        nullable=False
+    )
+
+    album = db.relationship('Album')
+
+    def serialize(self):
+        """Returns a dictionary of the recommended album and its score"""
+
+        return {
+            'album': self.album.serialize(),
+            'score': self.score
+        }
+
+
+class TrendingAlbum(db.Model):
+    """Time-decayed rating activity of an album for each trending window.
+
+    Scores use forward decay relative to TRENDING_EPOCH and are stored as logs,
+    so a new rating only adds to its album's score, the ranking never has to be
+    recomputed as time passes and the values never overflow."""
+
+    __tablename__ = "trending_albums"
+
+    __table_args__ = (db.Index('ix_trending_albums_period_log_score',
+                               'period', 'log_score'),)
+
+    period = db.Column(
+        db.String(10),
+        primary_key=True,
+        nullable=False
+    )
+
+    album_id = db.Column(
+        db.String(30),
+        db.ForeignKey("albums.id", ondelete="cascade"),
+        primary_key=True,
+        nullable=False
+    )
+
+    log_score = db.Column(
+        db.Float,
+        nullable=False
+    )
+
+    album = db.relationship('Album')
+
+    def serialize(self, now=None):
+        """Returns a dictionary of the album and its score decayed to now"""
+
+        return {
+            'album': self.album.serialize(),
+            'score': math.exp(
+                self.log_score - self.decay_offset(self.period, now))
+        }
+
+    @staticmethod
+    def decay_offset(window, time=None):
+        """Returns the log weight of a rating made at the given time (default
+        now) in the given window"""
+
+        tau = TRENDING_WINDOWS[window]
+
+        if tau is None:
+            return 0.0
+
+        return ((time or datetime.now()) - TRENDING_EPOCH) / tau
+
+    @classmethod
+    def add_rating(cls, album_id, timestamp, connection=None):
+        """Adds a rating made at the given time to the album's score in every
+        window with a single upsert"""
+
+        statement = insert(cls).values([
+            {
+                'period': window,
+                'album_id': album_id,
+                'log_score': cls.decay_offset(window, timestamp)
+            }
+            for window in TRENDING_WINDOWS
+        ])
+
+        statement = statement.on_conflict_do_update(
+            index_elements=['period', 'album_id'],
+            set_={'log_score': log_add_exp(cls.log_score,
+                                           statement.excluded.log_score)})
+
+        (connection or db.session).execute(statement)
+
+    @classmethod
+    def top(cls, window, limit):
+        """Returns the `limit` highest scoring albums of the given window"""
+
+        return (cls.query
+                .options(joinedload(cls.album))
+                .filter_by(period=window)
+                .order_by(cls.log_score.desc())
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def compact(cls, horizon=10, min_score=0.01):
+        """Rebuilds every window from the ratings table, which corrects for
+        edited and deleted ratings. Decaying windows only consider ratings
+        younger than `horizon` time constants and drop albums whose decayed
+        score is below `min_score`. The all time window also counts archived
+        ratings."""
+
+        now = datetime.now()
+
+        for window, tau in TRENDING_WINDOWS.items():
+            db.session.execute(db.delete(cls).where(cls.period == window))
+
+            if tau is None:
+                ratings = all_ratings()
+                log_score = db.func.ln(db.func.count())
+                recent = db.true()
+                minimum = db.true()
+            else:
+                ratings = Rating.__table__
+                log_score = (db.func.ln(db.func.sum(db.func.exp(
+                    db.func.extract('epoch', ratings.c.timestamp - now)
+                    / tau.total_seconds())))
+                    + cls.decay_offset(window, now))
+                recent = ratings.c.timestamp > now - horizon * tau
+                minimum = (db.func.sum(db.func.exp(
+                    db.func.extract('epoch', ratings.c.timestamp - now)
+                    / tau.total_seconds())) >= min_score)
+
+            scores = (db.select(db.literal(window), ratings.c.album_id,
+                                log_score)
+                      .where(recent)
+                      .group_by(ratings.c.album_id)
+                      .having(minimum))
+
+            db.session.execute(
+                insert(cls).from_select(
+                    ['period', 'album_id', 'log_score'], scores))
+
+        db.session.commit()
+
+
+def log_add_exp(a, b):
+    """Returns a SQL expression for log(exp(a) + exp(b)) that cannot
+    overflow or underflow"""
+
+    return (db.func.greatest(a, b)
+            + db.func.ln(1 + db.func.exp(
+                -db.func.least(db.func.abs(a - b), 50))))
+
+
+class Job(db.Model):
+    """Background job waiting to be run, or failed, by a worker"""
+
+    __tablename__ = "jobs"
+
+    __table_args__ = (
+        db.Index('ix_jobs_dedup_key', 'dedup_key', unique=True,
+                 postgresql_where=db.text("status IN ('pending', 'running')")),
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+
+    kind = db.Column(
+        db.String(50),
+        nullable=False
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict
+    )
+
+    dedup_key = db.Column(
+        db.String(255)
+    )
+
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='pending'
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.now
+    )
+
+    locked_at = db.Column(
+        db.DateTime
+    )
+
+    last_error = db.Column(
+        db.Text
+    )
+
+    def __repr__(self):
+        return f"<Job {self.id}: {self.kind} {self.status}>"
+
+
+class SearchResult(db.Model):
+    """Cached page of filtered spotify search results for a normalized query"""
+
+    __tablename__ = "search_results"
+
+    __table_args__ = (
+        db.Index('ix_search_results_fetched_at', 'fetched_at'),
+    )
+
+    search_type = db.Column(
+        db.String(10),
+        primary_key=True,
+        nullable=False
+    )
+
+    normalized_query = db.Column(
+        db.String(255),
+        primary_key=True,
+        nullable=False
+    )
+
+    offset = db.Column(
+        db.Integer,
+        primary_key=True,
+        nullable=False
+    )
+
+    results = db.Column(
+        db.JSON,
+        nullable=False
+    )
+
+    total = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    fetched_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.now
+    )
+
+
+class AutocompleteEntry(db.Model):
+    """Album or artist name indexed for prefix search without spotify calls"""
+
+    __tablename__ = "autocomplete_entries"
+
+    __table_args__ = (
+        db.Index('ix_autocomplete_entries_search_name', 'search_name',
+                 postgresql_ops={'search_name': 'text_pattern_ops'}),
+    )
+
+    kind = db.Column(
+        db.String(10),
+        primary_key=True,
+        nullable=False
+    )
+
+    item_id = db.Column(
+        db.String(30),
+        primary_key=True,
+        nullable=False
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False
+    )
+
+    search_name = db.Column(
+        db.Text,
+        nullable=False
+    )
+
+    image_url = db.Column(
+        db.String(255)
+    )
+
+    artist_name = db.Column(
+        db.Text
+    )
+
+    artist_id = db.Column(
+        db.String(30)
+    )
+
+    def serialize(self):
+        """Returns a dictionary in the shape of the matching spotify search
+        result"""
+
+        if self.kind == 'album':
+            return {
+                'name': self.name,
+                'image_url': self.image_url,
+                'id': self.item_id,
+                'artist': self.artist_name,
+                'artist_id': self.artist_id
+            }
+
+        return {
+            'name': self.name,
+            'image_url': self.image_url,
+            'id': self.item_id
+        }
+
+
+class FeedEvent(db.Model):
+    """Outbox of new and edited ratings, written in the same transaction as
+    the rating. Ids are taken from a sequence before commit, so transactions
+    can make them visible out of order. Events are also given a position as
+    their transaction commits, one transaction at a time, so a position only
+    becomes visible after all lower ones. Positions are the event ids of the
+    ratings stream, so clients can resume from the last one they saw."""
+
+    __tablename__ = "feed_events"
+
+    __table_args__ = (
+        db.Index('ix_feed_events_author_position', 'author', 'position'),
+        db.Index('ix_feed_events_position', 'position', unique=True),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+
+    rating_id = db.Column(
+        db.Integer,
+        db.ForeignKey('ratings.id', ondelete='cascade'),
+        nullable=False
+    )
+
+    author = db.Column(
+        db.String(20),
+        db.ForeignKey('users.username', ondelete='cascade'),
+        nullable=False
+    )
+
+    kind = db.Column(
+        db.String(10),
+        nullable=False
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.now
+    )
+
+    position = db.Column(
+        db.BigInteger
+    )
+
+    rating = db.relationship('Rating')
+
+    def serialize(self):
+        """Returns a dictionary of the event and its rating"""
+
+        return {
+            'id': self.position,
+            'kind': self.kind,
+            'rating': self.rating.serialize()
+        }
+
+    @classmethod
+    def record(cls, rating_id, author, kind, connection, session):
+        """Adds an event for a rating to the outbox on the given connection,
+        to be positioned when the session commits. On PostgreSQL the author
+        is announced with NOTIFY, which is only delivered once the transaction
+        commits. Elsewhere the author is kept in the session's info for the
+        in-process broker to publish after commit."""
+
+        event_id = connection.execute(
+            db.insert(cls)
+            .values(rating_id=rating_id, author=author, kind=kind,
+                    created_at=datetime.now())
+            .returning(cls.id)).scalar()
+
+        session.info.setdefault('feed_event_ids', []).append(event_id)
+
+        if connection.dialect.name == 'postgresql':
+            connection.execute(
+                db.select(db.func.pg_notify(FEED_CHANNEL, author)))
+        else:
+            session.info.setdefault('feed_authors', set()).add(author)
+
+    @classmethod
+    def position_recorded(cls, session):
+        """Positions the events recorded in a session after the newest
+        positioned event. On PostgreSQL this holds an advisory lock until the
+        transaction ends, so transactions are positioned in commit order."""
+
+        event_ids = session.info.pop('feed_event_ids', None)
+
+        if not event_ids:
+            return
+
+        connection = session.connection()
+
+        if connection.dialect.name == 'postgresql':
+            connection.execute(db.select(
+                db.func.pg_advisory_xact_lock(FEED_POSITION_LOCK)))
+
+        newest = connection.execute(
+            db.select(db.func.max(cls.position))).scalar() or 0
+
+        for offset, event_id in enumerate(event_ids, 1):
+            connection.execute(
+                db.update(cls)
+                .where(cls.id == event_id)
+                .values(position=newest + offset))
+
+
+@event.listens_for(Session, 'before_commit')
+def position_feed_events(session):
+    """Flushes a committing session, whose flush may record feed events, and
+    positions its feed events just before the commit"""
+
+    session.flush()
+    FeedEvent.position_recorded(session)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_feed_event_ids(session):
+    session.info.pop('feed_event_ids', None)
+
+
+class CacheVersion(db.Model):
+    """Version counters of cached data, such as a user's ratings. They are
+    bumped in the same transaction as the write that changes the data, and a
+    cache entry is only served while the versions it was built from are
+    current."""
+
+    __tablename__ = "cache_versions"
+
+    key = db.Column(
+        db.String(64),
+        primary_key=True
+    )
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1
+    )
+
+    @classmethod
+    def get_many(cls, keys):
+        """Returns a dictionary of the current version of each key, 0 for keys
+        never bumped, with one query"""
+
+        versions = dict.fromkeys(keys, 0)
+        versions.update(db.session.execute(
+            db.select(cls.key, cls.version).where(cls.key.in_(keys))).all())
+
+        return versions
+
+    @classmethod
+    def bump(cls, keys, connection=None):
+        """Increments the versions of the given keys with a single upsert,
+        locking them in key order so concurrent writes can't deadlock"""
+
+        statement = insert(cls).values(
+            [{'key': key, 'version': 1} for key in sorted(set(keys))])
+
+        statement = statement.on_conflict_do_update(
+            index_elements=['key'],
+            set_={'version': cls.version + 1})
+
+        (connection or db.session).execute(statement)
+
+
+def user_ratings_version_key(username):
+    """Returns the cache version key of a user's ratings"""
+
+    return f'ratings:user:{username}'
+
+
+def album_ratings_version_key(album_id):
+    """Returns the cache version key of an album's ratings"""
+
+    return f'ratings:album:{album_id}'
+
+
+def rating_version_keys(author, album_id):
+    """Returns the cache version keys of the rating lists a rating is in"""
+
+    return [user_ratings_version_key(author),
+            album_ratings_version_key(album_id)]
+
+
+def follows_version_key(username):
+    """Returns the cache version key of the users a user follows"""
+
+    return f'follows:{username}'
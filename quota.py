@@ -0,0 +1,179 @@
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# Background calls only take tokens while the bucket is at least this full, so
+# a burst of hydration jobs can never starve user requests
+BACKGROUND_RESERVE = 0.5
+
+MAX_WAIT = {
+    INTERACTIVE: 2.0,
+    BACKGROUND: 60.0
+}
+
+_priority = ContextVar('spotify_priority', default=INTERACTIVE)
+
+
+class TokenBucket:
+    """Token bucket holding up to `capacity` tokens refilled at `rate` per
+    second. Subclasses store the state so it can be shared between
+    processes."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+
+    def try_acquire(self, reserve=0.0):
+        """Takes a token if more than `reserve` tokens would be left. Returns 0
+        on success, otherwise the number of seconds until one is available."""
+
+        with self.state() as state:
+            now = time.time()
+
+            if state['blocked_until'] > now:
+                return state['blocked_until'] - now
+
+            state['tokens'] = min(
+                self.capacity,
+                state['tokens'] + (now - state['updated']) * self.rate)
+            state['updated'] = now
+
+            if state['tokens'] - 1 >= reserve:
+                state['tokens'] -= 1
+                return 0
+
+            return (reserve + 1 - state['tokens']) / self.rate
+
+    def block(self, seconds):
+        """Empties the bucket and stops handing out tokens for `seconds`, used
+        when spotify answers with a 429"""
+
+        with self.state() as state:
+            state['tokens'] = 0
+            state['updated'] = time.time()
+            state['blocked_until'] = max(state['blocked_until'],
+                                         time.time() + seconds)
+
+    def initial_state(self):
+        """Returns the state of a full bucket"""
+
+        return {'tokens': self.capacity, 'updated': time.time(),
+                'blocked_until': 0}
+
+
+class MemoryTokenBucket(TokenBucket):
+    """Token bucket shared by the threads of a single process"""
+
+    def __init__(self, rate, capacity):
+        super().__init__(rate, capacity)
+        self.lock = Lock()
+        self.data = self.initial_state()
+
+    @contextmanager
+    def state(self):
+        """Yields the bucket state while holding the process lock"""
+
+        with self.lock:
+            yield self.data
+
+
+class FileTokenBucket(TokenBucket):
+    """Token bucket stored in a small JSON file and locked with flock, shared
+    by every worker process on the host"""
+
+    def __init__(self, rate, capacity, path):
+        super().__init__(rate, capacity)
+        self.path = path
+
+    @contextmanager
+    def state(self):
+        """Yields the bucket state read from the file while holding an
+        exclusive lock on it, then writes it back"""
+
+        with open(self.path, 'a+') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                file.seek(0)
+                try:
+                    data = json.loads(file.read())
+                except ValueError:
+                    data = self.initial_state()
+
+                yield data
+
+                file.seek(0)
+                file.truncate()
+                file.write(json.dumps(data))
+                file.flush()
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def create_bucket():
+    """Creates the spotify token bucket from the SPOTIFY_RATE_LIMIT (requests
+    per second), SPOTIFY_BURST and SPOTIFY_QUOTA_FILE environment variables,
+    falling back to a per-process bucket where flock is unavailable"""
+
+    rate = float(os.environ.get('SPOTIFY_RATE_LIMIT', 10))
+    capacity = float(os.environ.get('SPOTIFY_BURST', 20))
+    path = os.environ.get('SPOTIFY_QUOTA_FILE', os.path.join(
+        tempfile.gettempdir(), 'album-rater-spotify-quota.json'))
+
+    if fcntl is None:
+        return MemoryTokenBucket(rate, capacity)
+
+    return FileTokenBucket(rate, capacity, path)
+
+
+bucket = create_bucket()
+
+
+@contextmanager
+def background_priority():
+    """Marks spotify calls made inside the block as background work"""
+
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def acquire():
+    """Waits for a spotify request token at the current priority. Returns True
+    once one is taken, or False if none was available within the priority's
+    maximum wait. Wait times are recorded per priority in metrics."""
+
+    priority = _priority.get()
+    reserve = (bucket.capacity * BACKGROUND_RESERVE
+               if priority == BACKGROUND else 0.0)
+    start = time.monotonic()
+    deadline = start + MAX_WAIT[priority]
+
+    while True:
+        wait = bucket.try_acquire(reserve)
+        now = time.monotonic()
+
+        if not wait:
+            metrics.observe(f'spotify.quota_wait.{priority}', now - start)
+            return True
+
+        if now + wait > deadline:
+            metrics.increment(f'spotify.quota_rejected.{priority}')
+            return False
+
+        time.sleep(wait)
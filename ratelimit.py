@@ -0,0 +1,209 @@
+import time
+from functools import wraps
+from math import ceil
+from threading import Lock
+
+from flask import request, jsonify, current_app
+from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
+
+import metrics
+from sqlite_table import SQLiteTable
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400
+}
+
+PRUNE_EVERY = 1000
+
+
+def parse_limit(limit):
+    """Parses a limit such as "10/minute" into (count, window seconds)"""
+
+    count, period = limit.split('/')
+    return int(count), PERIODS[period.strip()]
+
+
+class MemoryStore:
+    """Window counters kept in this process"""
+
+    def __init__(self):
+        self.counts = {}
+        self.expires = {}
+        self.lock = Lock()
+        self.hits = 0
+
+    def increment(self, key, expires_at):
+        """Adds one to a counter and returns its new value"""
+
+        with self.lock:
+            self.hits += 1
+            if self.hits % PRUNE_EVERY == 0:
+                self.prune()
+
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.expires[key] = expires_at
+
+            return self.counts[key]
+
+    def get(self, key):
+        """Returns the value of a counter"""
+
+        with self.lock:
+            return self.counts.get(key, 0)
+
+    def prune(self):
+        """Drops expired counters, called with the lock held"""
+
+        now = time.time()
+        for key in [key for key, expires_at in self.expires.items()
+                    if expires_at < now]:
+            del self.counts[key]
+            del self.expires[key]
+
+
+class SQLiteStore:
+    """Window counters kept in a SQLite file, shared by every worker process
+    on the host"""
+
+    def __init__(self, path):
+        self.table = SQLiteTable(
+            path, 'rate_limits',
+            "key TEXT PRIMARY KEY, count INTEGER NOT NULL, "
+            "expires_at REAL NOT NULL")
+
+    def increment(self, key, expires_at):
+        """Adds one to a counter and returns its new value"""
+
+        (count,) = self.table.write(
+            "INSERT INTO rate_limits (key, count, expires_at) VALUES (?, 1, ?) "
+            "ON CONFLICT (key) DO UPDATE SET count = count + 1 "
+            "RETURNING count",
+            (key, expires_at))
+
+        return count
+
+    def get(self, key):
+        """Returns the value of a counter"""
+
+        row = self.table.read(
+            "SELECT count FROM rate_limits WHERE key = ?", (key,))
+
+        return row[0] if row else 0
+
+
+def create_store(url):
+    """Creates a counter store from a URL, either memory:// or
+    sqlite:///path/to/file"""
+
+    if url.startswith('sqlite:///'):
+        return SQLiteStore(url[len('sqlite:///'):])
+
+    return MemoryStore()
+
+
+class RateLimiter:
+    """Sliding window rate limiter. Each window's count is kept in a fixed
+    window counter, and the previous window's count is weighted by how much
+    of it still overlaps the sliding window."""
+
+    def __init__(self, app=None):
+        self.store = MemoryStore()
+        self.enabled = True
+
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configures the store from RATELIMIT_STORAGE_URL and applies the
+        per-IP RATELIMIT_DEFAULT limit to every request"""
+
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_STORAGE_URL', 'memory://')
+        app.config.setdefault('RATELIMIT_DEFAULT', '600/minute')
+
+        self.enabled = app.config['RATELIMIT_ENABLED']
+        self.store = create_store(app.config['RATELIMIT_STORAGE_URL'])
+
+        @app.before_request
+        def apply_default_limit():
+            """Limits every request by client IP"""
+
+            if app.config['RATELIMIT_DEFAULT']:
+                return self.check(app.config['RATELIMIT_DEFAULT'],
+                                  scope='default', key=client_ip())
+
+    def hit(self, key, limit):
+        """Counts a request against a limit. Returns 0 if it is allowed,
+        otherwise the number of seconds to wait before retrying."""
+
+        count, window = parse_limit(limit)
+        now = time.time()
+        current = int(now // window)
+        elapsed = now - current * window
+
+        hits = self.store.increment(f'{key}:{window}:{current}',
+                                    expires_at=(current + 2) * window)
+        previous = self.store.get(f'{key}:{window}:{current - 1}')
+
+        if previous * (1 - elapsed / window) + hits > count:
+            return max(1, ceil(window - elapsed))
+
+        return 0
+
+    def check(self, limit, scope, key):
+        """Returns a 429 response if the key is over the limit in this scope,
+        otherwise None"""
+
+        if not self.enabled:
+            return None
+
+        retry_after = self.hit(f'{scope}:{key}', limit)
+
+        if not retry_after:
+            return None
+
+        metrics.increment(f'ratelimit.rejected.{scope}')
+        current_app.logger.warning("Rate limited %s on %s", key, scope)
+
+        return (jsonify({"errors": ["Too many requests."]}), 429,
+                {"Retry-After": str(retry_after)})
+
+    def limit(self, limit, by='identity'):
+        """Decorator limiting a route to `limit` requests per user (falling
+        back to the client IP for anonymous requests) or, with by='ip', per
+        client IP"""
+
+        def decorator(f):
+            @wraps(f)
+            def rate_limit_decorator(*args, **kwargs):
+                key = client_ip() if by == 'ip' else client_identity()
+                response = self.check(limit, scope=request.endpoint, key=key)
+
+                return response or f(*args, **kwargs)
+            return rate_limit_decorator
+        return decorator
+
+
+def client_ip():
+    """Returns the address of the client making the request"""
+
+    return request.remote_addr or 'unknown'
+
+
+def client_identity():
+    """Returns the JWT username of the request, or the client IP if it has no
+    valid token"""
+
+    try:
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+    except Exception:
+        identity = None
+
+    if identity:
+        return f'user:{identity["username"]}'
+
+    return f'ip:{client_ip()}'
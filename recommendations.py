@@ -0,0 +1,298 @@
+import numpy as np
+from scipy import sparse
+
+from jobs import job_handler
+from models import (db, Follow, UserRecommendation, SimilarAlbum,
+                    AlbumRecommendation, all_ratings)
+
+USER_RECOMMENDATION_COUNT = 20
+SIMILAR_ALBUM_COUNT = 20
+ALBUM_RECOMMENDATION_COUNT = 50
+TASTE_WEIGHT = 2.0
+TASTE_MAX_RATERS = 500
+CHUNK_SIZE = 2000
+USER_CHUNK_SIZE = 500
+ALBUM_CHUNK_SIZE = 500
+
+
+def index_values(values):
+    """Takes an array of keys and returns the sorted unique keys along with the
+    position of each key in that sorted array"""
+
+    keys, positions = np.unique(np.asarray(values, dtype=object),
+                                return_inverse=True)
+    return keys, positions
+
+
+def build_follow_matrix(followers, followed, usernames):
+    """Builds a sparse user-by-user matrix where entry (i, j) is 1 if user i
+    follows user j. `usernames` must be sorted."""
+
+    n = len(usernames)
+    rows = np.searchsorted(usernames, np.asarray(followers, dtype=object))
+    cols = np.searchsorted(usernames, np.asarray(followed, dtype=object))
+
+    return sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(n, n))
+
+
+def build_rating_matrix(user_positions, album_positions, scores, shape):
+    """Builds a sparse user-by-album matrix of ratings centered on each user's
+    mean rating, so similarity reflects taste rather than generosity"""
+
+    matrix = sparse.csr_matrix(
+        (np.asarray(scores, dtype=np.float32),
+         (user_positions, album_positions)),
+        shape=shape)
+
+    counts = np.diff(matrix.indptr)
+    sums = np.asarray(matrix.sum(axis=1)).ravel()
+    means = np.divide(sums, counts, out=np.zeros_like(sums),
+                      where=counts > 0)
+
+    matrix.data -= np.repeat(means, counts).astype(np.float32)
+    matrix.eliminate_zeros()
+
+    return matrix
+
+
+def normalize_rows(matrix):
+    """Scales each row of a sparse matrix to unit length"""
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+
+    return sparse.diags(1 / norms).dot(matrix).tocsr()
+
+
+def drop_popular_columns(matrix, max_count):
+    """Zeroes the columns of a sparse matrix with more than `max_count` stored
+    entries, e.g. albums with so many raters that they say little about taste
+    yet would make every pair of those raters similar"""
+
+    matrix = matrix.tocsr(copy=True)
+    counts = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    matrix.data[counts[matrix.indices] > max_count] = 0
+    matrix.eliminate_zeros()
+
+    return matrix
+
+
+def top_n_per_row(matrix, n):
+    """Returns the row, column, score and rank arrays of the `n` highest
+    positive entries in each row of a sparse matrix"""
+
+    matrix = matrix.tocsr()
+    matrix.data[matrix.data <= 0] = 0
+    matrix.eliminate_zeros()
+
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    order = np.lexsort((-matrix.data, rows))
+    rows = rows[order]
+    ranks = np.arange(len(order)) - matrix.indptr[rows]
+    keep = ranks < n
+
+    return (rows[keep], matrix.indices[order][keep],
+            matrix.data[order][keep], ranks[keep])
+
+
+def offset_identity(start, stop, width):
+    """Returns the rows `start` to `stop` of a `width` square identity matrix,
+    used to mask each row's own entry out of a chunk of scores"""
+
+    return sparse.csr_matrix(
+        (np.ones(stop - start, dtype=np.float32),
+         (np.arange(stop - start), np.arange(start, stop))),
+        shape=(stop - start, width))
+
+
+def recommend_users(follow_matrix, rating_matrix, n=USER_RECOMMENDATION_COUNT,
+                    taste_weight=TASTE_WEIGHT, chunk_size=USER_CHUNK_SIZE,
+                    max_raters=TASTE_MAX_RATERS):
+    """Scores every user against every other user by friends-of-friends counts
+    plus weighted taste similarity, excluding themselves and users they already
+    follow. Taste only counts albums with at most `max_raters` raters, which
+    keeps each chunk's taste product sparse. Yields (row, column, score, rank)
+    arrays per chunk of users."""
+
+    normalized = normalize_rows(
+        drop_popular_columns(rating_matrix, max_raters))
+    normalized_t = normalized.T.tocsr()
+    follow_matrix = follow_matrix.tocsr()
+
+    for start in range(0, follow_matrix.shape[0], chunk_size):
+        stop = min(start + chunk_size, follow_matrix.shape[0])
+        follows = follow_matrix[start:stop]
+
+        friends_of_friends = follows.dot(follow_matrix)
+        friends_of_friends.data = np.log1p(friends_of_friends.data)
+
+        taste = normalized[start:stop].dot(normalized_t)
+        taste.data = np.maximum(taste.data, 0)
+
+        scores = friends_of_friends + taste_weight * taste
+
+        excluded = follows + offset_identity(start, stop, follows.shape[1])
+        excluded.data[:] = 1
+        scores = scores - scores.multiply(excluded)
+
+        rows, cols, values, ranks = top_n_per_row(scores, n)
+
+        yield rows + start, cols, values, ranks
+
+
+def similar_albums(rating_matrix, k=SIMILAR_ALBUM_COUNT,
+                   chunk_size=ALBUM_CHUNK_SIZE):
+    """Computes item-item cosine similarity between the columns of a centered
+    user-by-album rating matrix, keeping the `k` most similar albums of each
+    album. Yields (row, column, score, rank) arrays per chunk of albums."""
+
+    normalized = normalize_rows(rating_matrix.T.tocsr())
+    normalized_t = normalized.T.tocsr()
+    album_count = normalized.shape[0]
+
+    for start in range(0, album_count, chunk_size):
+        stop = min(start + chunk_size, album_count)
+
+        similarity = normalized[start:stop].dot(normalized_t)
+        similarity = similarity - similarity.multiply(
+            offset_identity(start, stop, album_count))
+
+        rows, cols, values, ranks = top_n_per_row(similarity, k)
+
+        yield rows + start, cols, values, ranks
+
+
+def recommend_albums(rating_matrix, similarity, n=ALBUM_RECOMMENDATION_COUNT,
+                     chunk_size=CHUNK_SIZE):
+    """Scores every album for every user as the sum of their centered ratings
+    weighted by each rated album's similarity to it, excluding albums they
+    already rated. Yields (row, column, score, rank) arrays per chunk of
+    users."""
+
+    rating_matrix = rating_matrix.tocsr()
+    similarity = similarity.tocsr()
+
+    for start in range(0, rating_matrix.shape[0], chunk_size):
+        stop = min(start + chunk_size, rating_matrix.shape[0])
+        ratings = rating_matrix[start:stop]
+
+        scores = ratings.dot(similarity)
+
+        rated = ratings.copy()
+        rated.data[:] = 1
+        scores = scores - scores.multiply(rated)
+
+        rows, cols, values, ranks = top_n_per_row(scores, n)
+
+        yield rows + start, cols, values, ranks
+
+
+def chunks_to_matrix(chunks, shape):
+    """Combines (row, column, score, rank) chunks into a sparse score matrix"""
+
+    if not chunks:
+        return sparse.csr_matrix(shape, dtype=np.float32)
+
+    rows, cols, values, ranks = (np.concatenate(arrays)
+                                 for arrays in zip(*chunks))
+
+    return sparse.csr_matrix((values, (rows, cols)), shape=shape)
+
+
+def load_rating_matrix(usernames=None):
+    """Fetches the author, album and score columns of every rating, archived
+    or not, and returns the sorted usernames, sorted album ids and the centered
+    rating matrix. Users in `usernames` are indexed even if they have no
+    ratings."""
+
+    history = all_ratings()
+    ratings = db.session.execute(
+        db.select(history.c.author, history.c.album_id,
+                  history.c.rating)).all()
+    authors, album_ids, scores = zip(*ratings) if ratings else ((), (), ())
+
+    usernames, positions = index_values(
+        list(usernames if usernames is not None else ()) + list(authors))
+    author_positions = positions[len(positions) - len(authors):]
+    albums, album_positions = index_values(album_ids)
+
+    rating_matrix = build_rating_matrix(
+        author_positions, album_positions, scores,
+        shape=(len(usernames), len(albums)))
+
+    return usernames, albums, rating_matrix
+
+
+def replace_rows(model, chunks, to_row):
+    """Deletes every row of `model` and inserts the rows built by `to_row` from
+    each (row, column, score, rank) in the chunks, in one transaction"""
+
+    db.session.execute(db.delete(model))
+
+    for rows, cols, values, ranks in chunks:
+        if not len(rows):
+            continue
+
+        db.session.execute(db.insert(model), [
+            to_row(row, col, float(score), int(rank))
+            for row, col, score, rank in zip(rows, cols, values, ranks)
+        ])
+
+    db.session.commit()
+
+
+@job_handler('recommend_users')
+def compute_user_recommendations(n=USER_RECOMMENDATION_COUNT):
+    """Recomputes the top `n` recommended users for every user from the follow
+    graph and rating history and replaces the stored recommendations"""
+
+    follows = db.session.execute(
+        db.select(Follow.user_following, Follow.user_being_followed)).all()
+    followers, followed = zip(*follows) if follows else ((), ())
+
+    usernames, albums, rating_matrix = load_rating_matrix(
+        list(followers) + list(followed))
+    follow_matrix = build_follow_matrix(followers, followed, usernames)
+
+    replace_rows(
+        UserRecommendation,
+        recommend_users(follow_matrix, rating_matrix, n=n),
+        lambda row, col, score, rank: {
+            'username': usernames[row],
+            'recommended_username': usernames[col],
+            'score': score,
+            'rank': rank
+        })
+
+
+@job_handler('recommend_albums')
+def compute_album_recommendations(k=SIMILAR_ALBUM_COUNT,
+                                  n=ALBUM_RECOMMENDATION_COUNT):
+    """Recomputes the `k` most similar albums of every album and the top `n`
+    recommended albums of every user and replaces the stored results"""
+
+    usernames, albums, rating_matrix = load_rating_matrix()
+    similar = list(similar_albums(rating_matrix, k=k))
+
+    replace_rows(
+        SimilarAlbum,
+        similar,
+        lambda row, col, score, rank: {
+            'album_id': albums[row],
+            'similar_album_id': albums[col],
+            'score': score,
+            'rank': rank
+        })
+
+    similarity = chunks_to_matrix(similar, shape=(len(albums), len(albums)))
+
+    replace_rows(
+        AlbumRecommendation,
+        recommend_albums(rating_matrix, similarity, n=n),
+        lambda row, col, score, rank: {
+            'username': usernames[row],
+            'album_id': albums[col],
+            'score': score,
+            'rank': rank
+        })
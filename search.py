@@ -0,0 +1,299 @@
+import binascii
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import datetime, timedelta
+from math import ceil
+
+from sqlalchemy.dialects.postgresql import insert
+
+from jobs import enqueue, job_handler
+from models import db, Album, Artist, SearchResult, AutocompleteEntry
+from spotify import (get_token, album_search, artist_search,
+                     SEARCH_PAGE_SIZE, MAX_SEARCH_RESULTS)
+
+SEARCH_CACHE_TTL = timedelta(hours=6)
+SEARCH_RESULT_RETENTION = timedelta(days=7)
+AUTOCOMPLETE_LIMIT = 10
+INDEX_BATCH_SIZE = 1000
+MAX_CONCURRENT_PAGES = 4
+
+Page = namedtuple('Page', ['results', 'total', 'stale'])
+
+SPOTIFY_SEARCHES = {
+    'album': album_search,
+    'artist': artist_search
+}
+
+
+def normalize_query(query):
+    """Lowercases a search query and collapses its whitespace so equivalent
+    queries share cache entries"""
+
+    return ' '.join(query.lower().split())
+
+
+def cached_search(search_type, query, offset=0):
+    """Returns a page of spotify album or artist search results and whether
+    they are stale, serving them from the search cache when possible"""
+
+    offset = int(offset or 0)
+    page = get_pages(search_type, query, [offset])[offset]
+
+    return page.results, page.stale
+
+
+def get_pages(search_type, query, offsets):
+    """Returns a dictionary of upstream offset to Page for pages of spotify
+    search results. Cached pages are read with one query. Pages older than
+    SEARCH_CACHE_TTL are still served, marked stale, while a background job
+    refreshes them. Uncached pages are requested from spotify concurrently."""
+
+    query = normalize_query(query)[:255]
+    expires = datetime.now() - SEARCH_CACHE_TTL
+
+    cached = SearchResult.query.filter(
+        SearchResult.search_type == search_type,
+        SearchResult.normalized_query == query,
+        SearchResult.offset.in_(offsets)).all()
+
+    pages = {
+        page.offset: Page(page.results, page.total, page.fetched_at <= expires)
+        for page in cached}
+
+    for offset, page in pages.items():
+        if page.stale:
+            enqueue('refresh_search_page',
+                    {'search_type': search_type, 'query': query,
+                     'offset': offset},
+                    dedup_key=f'refresh_search_page:{search_type}:{offset}:'
+                              f'{query}'[:255])
+
+    missing = [offset for offset in offsets if offset not in pages]
+
+    if missing:
+        pages.update({
+            offset: Page(results, total, False)
+            for offset, (results, total)
+            in fetch_pages(search_type, query, missing).items()})
+
+    db.session.commit()
+
+    return pages
+
+
+def fetch_pages(search_type, query, offsets):
+    """Requests pages of search results from spotify concurrently, caches them
+    and adds them to the autocomplete index. Returns a dictionary of upstream
+    offset to (results, total). The caller commits."""
+
+    token = get_token()
+    search = SPOTIFY_SEARCHES[search_type]
+
+    # Each thread runs in a copy of this context to keep the spotify priority
+    contexts = [copy_context() for offset in offsets]
+
+    with ThreadPoolExecutor(max_workers=len(offsets)) as executor:
+        fetched = dict(zip(offsets, executor.map(
+            lambda offset, context: context.run(
+                search, query=query, offset=offset, token=token,
+                include_total=True),
+            offsets, contexts)))
+
+    statement = insert(SearchResult).values([{
+        'search_type': search_type,
+        'normalized_query': query,
+        'offset': offset,
+        'results': results,
+        'total': total,
+        'fetched_at': datetime.now()
+    } for offset, (results, total) in fetched.items()])
+
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['search_type', 'normalized_query', 'offset'],
+        set_={
+            'results': statement.excluded.results,
+            'total': statement.excluded.total,
+            'fetched_at': statement.excluded.fetched_at
+        }))
+
+    index_results(search_type, [
+        result for results, total in fetched.values() for result in results])
+
+    return fetched
+
+
+@job_handler('refresh_search_page')
+def refresh_search_page(search_type, query, offset):
+    """Refetches a cached page of search results from spotify"""
+
+    fetch_pages(search_type, query, [offset])
+    db.session.commit()
+
+
+@job_handler('prune_search_results')
+def prune_search_results():
+    """Deletes cached search pages that haven't been fetched for
+    SEARCH_RESULT_RETENTION. Pages that are still read are refreshed when
+    they go stale, so only abandoned queries are removed. Queue it from cron
+    with `flask enqueue-job prune_search_results`."""
+
+    SearchResult.query.filter(
+        SearchResult.fetched_at < datetime.now() - SEARCH_RESULT_RETENTION
+    ).delete()
+    db.session.commit()
+
+
+def encode_cursor(offset, skip):
+    """Encodes an upstream offset and the number of filtered results already
+    returned from that upstream page as an opaque continuation token"""
+
+    return urlsafe_b64encode(f"{offset}:{skip}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decodes a continuation token into an upstream offset and skip count.
+    Raises ValueError if the token is invalid."""
+
+    if not cursor:
+        return 0, 0
+
+    try:
+        offset, skip = urlsafe_b64decode(cursor.encode()).decode().split(":")
+        offset, skip = int(offset), int(skip)
+    except (ValueError, binascii.Error):
+        raise ValueError("Invalid cursor.")
+
+    if offset < 0 or skip < 0 or offset % SEARCH_PAGE_SIZE:
+        raise ValueError("Invalid cursor.")
+
+    return offset, skip
+
+
+def filled_search(search_type, query, cursor=None, page_size=SEARCH_PAGE_SIZE):
+    """Returns a full page of filtered search results, the continuation token
+    of the next page (None once spotify has no more matches) and whether any
+    of the results are stale. Upstream pages are fetched until the page is
+    full, several at a time when the filters are dropping many results."""
+
+    offset, skip = decode_cursor(cursor)
+    end = MAX_SEARCH_RESULTS
+    items = []
+    stale = False
+    batch_size = 1
+    pages_read = 0
+
+    while offset < end:
+        offsets = [page_offset for page_offset in range(
+            offset, offset + batch_size * SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE)
+            if page_offset < end]
+        pages = get_pages(search_type, query, offsets)
+
+        for page_offset in offsets:
+            page = pages[page_offset]
+            end = min(end, page.total)
+            stale = stale or page.stale
+            available = page.results[skip:]
+            needed = page_size - len(items)
+
+            if len(available) > needed:
+                items += available[:needed]
+                return items, encode_cursor(page_offset, skip + needed), stale
+
+            items += available
+            skip = 0
+            offset = page_offset + SEARCH_PAGE_SIZE
+            pages_read += 1
+
+            if len(items) == page_size or offset >= end:
+                break
+
+        if len(items) == page_size:
+            break
+
+        per_page = max(len(items) / pages_read, 1)
+        batch_size = min(
+            ceil((page_size - len(items)) / per_page), MAX_CONCURRENT_PAGES)
+
+    next_cursor = encode_cursor(offset, 0) if offset < end else None
+
+    return items, next_cursor, stale
+
+
+def index_results(search_type, results):
+    """Adds or updates autocomplete entries for spotify search results"""
+
+    if not results:
+        return
+
+    statement = insert(AutocompleteEntry).values([{
+        'kind': search_type,
+        'item_id': result['id'],
+        'name': result['name'],
+        'search_name': normalize_query(result['name']),
+        'image_url': result['image_url'],
+        'artist_name': result.get('artist'),
+        'artist_id': result.get('artist_id')
+    } for result in {result['id']: result for result in results}.values()])
+
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['kind', 'item_id'],
+        set_={
+            column: statement.excluded[column]
+            for column in ('name', 'search_name', 'image_url', 'artist_name',
+                           'artist_id')
+        }))
+
+
+def autocomplete(prefix, kind=None, limit=AUTOCOMPLETE_LIMIT):
+    """Returns albums and artists whose names start with the given prefix from
+    the local index, without calling spotify"""
+
+    prefix = normalize_query(prefix)
+
+    if not prefix:
+        return []
+
+    escaped = (prefix.replace('\\', '\\\\')
+               .replace('%', '\\%')
+               .replace('_', '\\_'))
+
+    entries = AutocompleteEntry.query.filter(
+        AutocompleteEntry.search_name.like(f'{escaped}%', escape='\\'))
+
+    if kind:
+        entries = entries.filter_by(kind=kind)
+
+    return (entries
+            .order_by(AutocompleteEntry.search_name)
+            .limit(limit)
+            .all())
+
+
+@job_handler('rebuild_autocomplete')
+def rebuild_autocomplete():
+    """Adds every album and hydrated artist in the local catalog to the
+    autocomplete index"""
+
+    albums = [{
+        'id': album.id,
+        'name': album.name,
+        'image_url': album.image_url,
+        'artist': album.artist_name,
+        'artist_id': album.artist_id
+    } for album in Album.query.all()]
+
+    artists = [{
+        'id': artist.id,
+        'name': artist.name,
+        'image_url': artist.image_url
+    } for artist in Artist.query.filter(Artist.fetched_at.isnot(None)).all()]
+
+    for start in range(0, len(albums), INDEX_BATCH_SIZE):
+        index_results('album', albums[start:start + INDEX_BATCH_SIZE])
+
+    for start in range(0, len(artists), INDEX_BATCH_SIZE):
+        index_results('artist', artists[start:start + INDEX_BATCH_SIZE])
+
+    db.session.commit()
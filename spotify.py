@@ -1,56 +1,228 @@
 import os
+import time
+from contextlib import contextmanager
+from threading import Lock
 
-import requests
-from dotenv import load_dotenv
 from datetime import datetime, timedelta
 
-load_dotenv()
+import metrics
+import quota
 
-SPOTIFY_CLIENT_ID = os.environ['CLIENT_ID']
-SPOTIFY_CLIENT_SECRET = os.environ['CLIENT_SECRET']
+# Both can point at a local stand-in, such as benchmarks/fake_spotify.py
+BASE_API_URL = os.environ.get(
+    'SPOTIFY_API_URL', "https://api.spotify.com/v1")
+TOKEN_URL = os.environ.get(
+    'SPOTIFY_TOKEN_URL', "https://accounts.spotify.com/api/token")
 
-BASE_API_URL = "https://api.spotify.com/v1"
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_RESULTS = 1000
+
+# (connect, read) timeouts in seconds for every spotify request
+REQUEST_TIMEOUT = (2, 5)
+
+_token = None
+
+
+class SpotifyError(Exception):
+    """Spotify returned an error or a response the app can't use"""
+
+    def __init__(self, message, status_code=502):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class SpotifyUnavailable(SpotifyError):
+    """Spotify is down, slow or rate limiting, or its circuit is open"""
+
+    def __init__(self, message, retry_after=30):
+        super().__init__(message, status_code=503)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures of an upstream endpoint. After
+    `failure_threshold` failures the circuit opens and calls fail fast for
+    `reset_timeout` seconds, then a single trial call is let through and
+    closes the circuit again if it succeeds."""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = Lock()
+
+    def is_open(self):
+        """Checks if calls are currently being rejected"""
+
+        return (self.opened_at is not None and
+                time.monotonic() - self.opened_at < self.reset_timeout)
+
+    def before_call(self):
+        """Raises SpotifyUnavailable if the call should fail fast"""
+
+        with self.lock:
+            if self.opened_at is None:
+                return
+
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+
+            if remaining > 0 or self.trial_running:
+                raise SpotifyUnavailable(
+                    f"Spotify {self.name} is unavailable.",
+                    retry_after=max(int(remaining), 1))
+
+            self.trial_running = True
+
+    def cancel_trial(self):
+        """Lets another trial call through after one was never made"""
+
+        with self.lock:
+            self.trial_running = False
+
+    def record_success(self):
+        """Closes the circuit"""
+
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        """Counts a failure, opening the circuit at the threshold or when a
+        trial call fails"""
+
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+
+            if self.opened_at is not None or \
+                    self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+BREAKERS = {
+    endpoint: CircuitBreaker(endpoint)
+    for endpoint in ('token', 'albums', 'artists', 'artist_albums', 'search')
+}
+
+
+def spotify_request(endpoint, method, url, **kwargs):
+    """Makes a request to spotify through the circuit breaker of the given
+    endpoint and the shared request quota, with strict timeouts, and returns
+    the decoded JSON. Raises SpotifyUnavailable when no quota is left, on
+    timeouts, connection errors, 429s and 5xx responses and SpotifyError on
+    other error responses."""
+
+    # Imported on first use so app workers that never call spotify skip it
+    import requests
+
+    breaker = BREAKERS[endpoint]
+    breaker.before_call()
+
+    if not quota.acquire():
+        breaker.cancel_trial()
+        raise SpotifyUnavailable("Spotify request quota is used up.",
+                                 retry_after=1)
+
+    metrics.increment(f'spotify.requests.{endpoint}')
+
+    try:
+        resp = requests.request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+    except requests.RequestException as e:
+        breaker.record_failure()
+        raise SpotifyUnavailable(f"Spotify {endpoint} request failed: {e}")
+
+    if resp.status_code == 429 or resp.status_code >= 500:
+        breaker.record_failure()
+        metrics.increment(f'spotify.errors.{resp.status_code}')
+
+        retry_after = resp.headers.get("Retry-After", "")
+        retry_after = int(retry_after) if retry_after.isdigit() else 30
+
+        if resp.status_code == 429:
+            quota.bucket.block(retry_after)
+
+        raise SpotifyUnavailable(
+            f"Spotify {endpoint} returned {resp.status_code}.",
+            retry_after=retry_after)
+
+    breaker.record_success()
+
+    if resp.status_code == 404:
+        raise SpotifyError("Not found on spotify.", status_code=404)
+
+    try:
+        resp.raise_for_status()
+        return resp.json()
+    except (requests.HTTPError, ValueError):
+        raise SpotifyError(
+            f"Spotify {endpoint} returned an invalid response.")
+
+
+@contextmanager
+def unexpected_response():
+    """Turns errors from missing keys in spotify data into SpotifyError"""
+
+    try:
+        yield
+    except (KeyError, IndexError, TypeError) as e:
+        raise SpotifyError(f"Unexpected response from spotify: {e!r}")
 
 
 def get_access_token():
     """Creates and returns new access token for spotify API"""
 
-    resp = requests.post(
-        "https://accounts.spotify.com/api/token",
+    token_data = spotify_request(
+        'token', 'POST', TOKEN_URL,
         data={
             "grant_type": "client_credentials",
-            "client_id": SPOTIFY_CLIENT_ID,
-            "client_secret": SPOTIFY_CLIENT_SECRET
+            "client_id": os.environ['CLIENT_ID'],
+            "client_secret": os.environ['CLIENT_SECRET']
         }
     )
-    token_data = resp.json()
 
-    exp_time = datetime.now() + timedelta(seconds=token_data['expires_in'])
+    with unexpected_response():
+        exp_time = datetime.now() + timedelta(seconds=token_data['expires_in'])
 
-    return {
-        "token": f"{token_data['token_type']} {token_data['access_token']}",
-        "exp_time": exp_time
-    }
+        return {
+            "token": f"{token_data['token_type']} {token_data['access_token']}",
+            "exp_time": exp_time
+        }
+
+
+def get_token():
+    """Returns a cached access token for spotify API, creating a new one if it
+    is missing or has expired"""
+
+    global _token
+
+    if not _token or _token['exp_time'] <= datetime.now():
+        _token = get_access_token()
+
+    return _token['token']
 
 
 def get_album_info(id, token):
     """Uses spotify API to get necessary data to add album to database"""
 
-    resp = requests.get(f"{BASE_API_URL}/albums/{id}", headers={
-        "Authorization": token
-    })
-    all_data = resp.json()
-
-    required_data = {
-        "id": id,
-        "name": all_data["name"],
-        "image_url": all_data["images"][0]["url"],
-        "tracks": all_data["tracks"]["items"],
-        "artists": [{
-            'name': artist['name'],
-            'id': artist['id']
-        } for artist in all_data["artists"]],
-    }
+    all_data = spotify_request('albums', 'GET', f"{BASE_API_URL}/albums/{id}",
+                               headers={"Authorization": token})
+
+    with unexpected_response():
+        required_data = {
+            "id": id,
+            "name": all_data["name"],
+            "image_url": all_data["images"][0]["url"],
+            "release_date": all_data.get("release_date"),
+            "tracks": all_data["tracks"]["items"],
+            "artists": [{
+                'name': artist['name'],
+                'id': artist['id']
+            } for artist in all_data["artists"]],
+        }
 
     return required_data
 
@@ -58,10 +230,8 @@ def get_album_info(id, token):
 def get_all_album_info(id, token):
     """Uses spotify API to get all data on an album"""
 
-    resp = requests.get(f"{BASE_API_URL}/albums/{id}", headers={
-        "Authorization": token
-    })
-    all_data = resp.json()
+    all_data = spotify_request('albums', 'GET', f"{BASE_API_URL}/albums/{id}",
+                               headers={"Authorization": token})
 
     return all_data
 
@@ -69,18 +239,18 @@ def get_all_album_info(id, token):
 def get_artist_info(id, token):
     """Uses spotify API to get all data on an artist"""
 
-    resp = requests.get(f"{BASE_API_URL}/artists/{id}", headers={
-        "Authorization": token
-    })
-    all_artist_data = resp.json()
-
-    return_data = {
-        'name': all_artist_data['name'],
-        'image_url': all_artist_data['images'][0]['url'],
-        'id': all_artist_data['id'],
-        'spotify_link': all_artist_data['external_urls']['spotify'],
-        'genres': all_artist_data['genres'],
-    }
+    all_artist_data = spotify_request(
+        'artists', 'GET', f"{BASE_API_URL}/artists/{id}",
+        headers={"Authorization": token})
+
+    with unexpected_response():
+        return_data = {
+            'name': all_artist_data['name'],
+            'image_url': all_artist_data['images'][0]['url'],
+            'id': all_artist_data['id'],
+            'spotify_link': all_artist_data['external_urls']['spotify'],
+            'genres': all_artist_data['genres'],
+        }
 
     return return_data
 
@@ -88,82 +258,95 @@ def get_artist_info(id, token):
 def get_artists_albums(artist_id, offset, token):
     """Uses spotify API to get albums made by a specific artist"""
 
-    resp = requests.get(f"{BASE_API_URL}/artists/{artist_id}/albums",
-                        headers={
-                            "Authorization": token
-                        }, params={
-                            'limit': 10,
-                            'offset': offset
-                        })
-    all_album_data = resp.json()
-
-    album_data = [{
-        'name': album['name'],
-        'release_year': album['release_date'][0:4],
-        'image_url': album['images'][0]['url'],
-        'id': album['id']
-    } for album in all_album_data['items']
-        if album['total_tracks'] >= 4 and
-        any(artist['id'] == artist_id for artist in album['artists'])]
+    all_album_data = spotify_request(
+        'artist_albums', 'GET', f"{BASE_API_URL}/artists/{artist_id}/albums",
+        headers={
+            "Authorization": token
+        }, params={
+            'limit': 10,
+            'offset': offset
+        })
+
+    with unexpected_response():
+        album_data = [{
+            'name': album['name'],
+            'release_year': album['release_date'][0:4],
+            'image_url': album['images'][0]['url'],
+            'id': album['id']
+        } for album in all_album_data['items']
+            if album['total_tracks'] >= 4 and
+            any(artist['id'] == artist_id for artist in album['artists'])]
 
     return album_data
 
 
-def album_search(query, offset, token):
-    """Uses spotify API to search for albums"""
+def album_search(query, offset, token, include_total=False):
+    """Uses spotify API to search for albums. If include_total is set, returns
+    a tuple of the results and the number of matches before filtering."""
 
     params = {
         'q': query,
         'type': 'album',
-        'limit': 20,
+        'limit': SEARCH_PAGE_SIZE,
         'offset': offset
     }
 
-    resp = requests.get(
+    all_data = spotify_request(
+        'search', 'GET',
         f"{BASE_API_URL}/search",
         params=params,
         headers={"Authorization": token}
     )
-    all_data = resp.json()
 
-    data = [
-        {
-            'name': album['name'],
-            'image_url': album['images'][1]['url'],
-            'id': album['id'],
-            'artist': album['artists'][0]['name'],
-            'artist_id': album['artists'][0]['id']
-        }
-        for album in all_data["albums"]['items']
-        if album['total_tracks'] >= 4]
+    with unexpected_response():
+        data = [
+            {
+                'name': album['name'],
+                'image_url': album['images'][1]['url'],
+                'id': album['id'],
+                'artist': album['artists'][0]['name'],
+                'artist_id': album['artists'][0]['id']
+            }
+            for album in all_data["albums"]['items']
+            if album['total_tracks'] >= 4]
+        total = all_data["albums"]["total"]
+
+    if include_total:
+        return data, total
 
     return data
 
 
-def artist_search(query, offset, token):
-    """Uses spotify API to search for artists"""
+def artist_search(query, offset, token, include_total=False):
+    """Uses spotify API to search for artists. If include_total is set, returns
+    a tuple of the results and the number of matches before filtering."""
 
     params = {
         'q': query,
         'type': 'artist',
-        'limit': 20,
+        'limit': SEARCH_PAGE_SIZE,
         'offset': offset
     }
 
-    resp = requests.get(
+    all_data = spotify_request(
+        'search', 'GET',
         f"{BASE_API_URL}/search",
         params=params,
         headers={"Authorization": token}
     )
-    all_data = resp.json()
 
-    data = [
-        {
-            'name': artist['name'],
-            'image_url': artist['images'][0]['url'],
-            'id': artist['id']
-        }
-        for artist in all_data["artists"]["items"]
-        if artist['images']]
+    with unexpected_response():
+        data = [
+            {
+                'name': artist['name'],
+                'image_url': artist['images'][0]['url'],
+                'id': artist['id']
+            }
+            for artist in all_data["artists"]["items"]
+            if artist['images']]
+        total = all_data["artists"]["total"]
+
+    if include_total:
+        return data, total
 
     return data
@@ -0,0 +1,49 @@
+import sqlite3
+import time
+from threading import local
+
+PRUNE_EVERY = 1000
+
+
+class SQLiteTable:
+    """A table in a SQLite file, shared by every worker process on the host.
+    Each thread gets its own connection, the table is created on first use
+    and rows past their expires_at column are pruned every PRUNE_EVERY
+    writes."""
+
+    def __init__(self, path, name, columns):
+        self.path = path
+        self.name = name
+        self.columns = columns
+        self.local = local()
+        self.writes = 0
+
+    @property
+    def connection(self):
+        """Returns this thread's connection, creating the table if needed"""
+
+        if not hasattr(self.local, 'connection'):
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.name} ({self.columns})")
+            self.local.connection = connection
+
+        return self.local.connection
+
+    def read(self, sql, parameters=()):
+        """Runs a query and returns its first row, or None"""
+
+        return self.connection.execute(sql, parameters).fetchone()
+
+    def write(self, sql, parameters=()):
+        """Runs a statement and returns its first row, or None, pruning
+        expired rows first every PRUNE_EVERY writes"""
+
+        self.writes += 1
+        if self.writes % PRUNE_EVERY == 0:
+            self.connection.execute(
+                f"DELETE FROM {self.name} WHERE expires_at < ?", (time.time(),))
+
+        return self.connection.execute(sql, parameters).fetchone()